@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+An asyncio counterpart of weiboarc, so that one process can drive many
+topic searches and timelines on a single event loop.
+"""
+
+from __future__ import absolute_import
+import asyncio
+import logging
+from collections import Counter
+import aiohttp
+from weiboarc import APIError, Weiboarc, WeiboResponse, RateLimitState, RetryPolicy, MAX_WEIBO_PER_PAGE, \
+    MAX_SEARCH_RESULTS, RATE_LIMIT_ERROR_CODES, RATE_LIMIT_URL, RETRY_RATE_LIMIT, classify_error, wait_seconds
+
+log = logging.getLogger(__name__)
+
+
+class AsyncWeiboarc(object):
+    """
+    AsyncWeiboarc mirrors Weiboarc with async generators.
+    """
+
+    def __init__(self, access_token, site=None, retry_policy=None):
+        self.access_token = access_token
+        self.site = site
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.rate_limit_state = RateLimitState.for_token(access_token)
+        self.client = AsyncClient(access_token, site=site)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        await self.client.close()
+
+    async def search_topic(self, q, since_id=None, max_id=None):
+        """
+        Return the latest 200 weibos related to a query topic
+        :param q: keyword for topic to search
+        :param since_id: it will return the weibo with id larger than the id
+        :param max_id: it will return the weibo with id smaller than the id
+        """
+        log.info(u"starting search for topic:%s.", q)
+        search_url = "search/topics"
+        params = {
+            'count': MAX_WEIBO_PER_PAGE,
+            'q': q
+        }
+        start_page = 1
+        while True:
+            params['page'] = start_page
+
+            # if access more than 200, avoid ["error_code": "21411", error": "only provide 200 results"]
+            if start_page * MAX_WEIBO_PER_PAGE > MAX_SEARCH_RESULTS:
+                break
+
+            resp = await self.get(search_url, **params)
+            statuses = resp.json().get('statuses', [])
+
+            if len(statuses) == 0:
+                logging.info("reach the end of calling for weibos statues.")
+                break
+
+            start_pos, end_pos = 0, len(statuses)
+            if max_id:
+                start_pos = Weiboarc._lower_bound(statuses, max_id)
+            if since_id:
+                end_pos = Weiboarc._upper_bound(statuses, since_id)
+
+            # checks the result after filtering
+            if len(statuses[start_pos:end_pos]) == 0:
+                logging.info("no new weibos matching since_id %s and max_id %s", since_id, max_id)
+                break
+
+            for status in statuses[start_pos:end_pos]:
+                yield status
+
+            max_id = status[u'id'] - 1
+
+            # if the page has apply filter and found the post id, it should be the last page
+            if 0 < (end_pos - start_pos) < len(statuses):
+                logging.info("reach the last page for since_id %s and max_id %s", since_id, max_id)
+                break
+
+            # go to the next page
+            start_page += 1
+
+    async def search_friendships(self, max_id=None, since_id=None):
+        """
+        Return all the results with optional max_id, since_id and get
+        back an async iterator for decoded weibo post.
+        :param since_id: it will return the weibo with id larger than the id
+        :param max_id: it will return the weibo with id smaller than the id
+        """
+        log.info("starting search for max_id:%s, since_id:%s.", max_id, since_id)
+        friendships_url = "statuses/friends_timeline"
+        params = {
+            'count': 100,
+            'page': 1
+        }
+
+        while True:
+            if since_id:
+                params['since_id'] = since_id
+            if max_id:
+                params['max_id'] = max_id
+
+            resp = await self.get(friendships_url, **params)
+            statuses = resp.json().get('statuses', [])
+            if len(statuses) == 0:
+                log.info("no new weibo post matching %s", params)
+                break
+
+            for status in statuses:
+                yield status
+
+            max_id = str(int(status[u'mid']) - 1)
+
+    async def get(self, *args, **kwargs):
+        """
+        Request the API, retrying the errors classified by classify_error as
+        scheduled by the retry policy.
+        """
+        started = self.retry_policy.clock()
+        errors = Counter()
+        while True:
+            r, error = None, None
+            try:
+                r = await self.client.get(*args, **kwargs)
+            except APIError as e:
+                log.error("caught APIError error %s", e)
+                error = e
+            except aiohttp.ClientConnectionError as e:
+                log.error("caught connection error %s", e)
+                error = e
+
+            if r is not None and r.status_code == 200:
+                if args[0] != RATE_LIMIT_URL:
+                    self.rate_limit_state.hit()
+                return r
+
+            kind = classify_error(r.status_code if r is not None else None, error)
+            if kind is None:
+                if error is not None:
+                    raise error
+                r.raise_for_status()
+                return r
+            errors[kind] += 1
+
+            if kind == RETRY_RATE_LIMIT:
+                if args[0] == RATE_LIMIT_URL:
+                    # not rate limited itself, the caller falls back to the hourly reset
+                    if error is not None:
+                        raise error
+                    r.raise_for_status()
+                error_code = error.error_code if error is not None else r.status_code
+                if error_code in RATE_LIMIT_ERROR_CODES:
+                    self.rate_limit_state.exhausted(ip=error_code == 10022)
+                else:
+                    # a 429 does not tell which limit is reached, the rate limit status does
+                    self.rate_limit_state.invalidate()
+                seconds = await self.wait_time()
+                logging.warning("Rate limit %d from Weibo API, Sleep %d to try...", error_code, seconds)
+            else:
+                if self.retry_policy.gives_up(kind, errors[kind]):
+                    logging.warning("Too many %s errors from Weibo API, stop!", kind)
+                    if error is not None:
+                        raise error
+                    r.raise_for_status()
+                # the connector discards the failed connection
+                seconds = self.retry_policy.backoff(errors[kind])
+                logging.warning("%s from Weibo API, sleeping %.1fs", error or r.status_code, seconds)
+            self.retry_policy.check(seconds, started)
+            await asyncio.sleep(seconds)
+
+    async def rate_limit(self):
+        """
+        To get the rate_limit of the APIs calling.
+        http://open.weibo.com/wiki/2/account/rate_limit_status
+        """
+        res = await self.get(RATE_LIMIT_URL)
+        rl = res.json()
+        self.rate_limit_state.update(rl)
+        return rl
+
+    async def rate_limit_status(self):
+        """
+        The locally accounted rate limit, only calling the API when it is stale.
+        """
+        if self.rate_limit_state.stale():
+            await self.rate_limit()
+        return self.rate_limit_state.status()
+
+    async def wait_time(self):
+        """
+        If a rate limit error is encountered we will sleep until we can
+        issue the API call again.
+        """
+        try:
+            rl = await self.rate_limit_status()
+        except Exception as e:
+            rl = None
+
+        return wait_seconds(rl)
+
+
+class AsyncClient(object):
+    """
+    The aiohttp counterpart of weiboarc.Client. The session is created lazily
+    since it has to be bound to the running event loop.
+    """
+
+    def __init__(self, access_token, site=None, decoder=None):
+        self.site = site or 'https://api.weibo.com/'
+        self.api_url = self.site + '2/'
+        self.access_token = access_token
+        self.decoder = decoder
+        self.session = None
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _assert_error(self, d):
+        """
+        Assert if json response is error.
+        """
+        if 'error_code' in d and 'error' in d:
+            raise APIError(d.get('error_code'), d.get('error', ''), d.get('request', ''))
+
+    async def get(self, uri, **kwargs):
+        """
+        Request resource by get method. The body is read before the response
+        is released and returned in a WeiboResponse.
+        """
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+
+        url = "{0}{1}.json".format(self.api_url, uri)
+        params = dict(kwargs, access_token=self.access_token)
+
+        async with self.session.get(url, params=params) as r:
+            res = WeiboResponse(r, r.status, await r.read(), decoder=self.decoder)
+        # 403 for invalid access token and rate limit
+        # 400 for information of expire token
+        if res.status_code in [200, 400, 403]:
+            self._assert_error(res.json())
+        return res
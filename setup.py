@@ -11,8 +11,10 @@ setup(
     test_suite='tests',
     scripts=['weibo_harvester.py',
              'weiboarc.py',
-             'weibo_warc_iter.py'],
-    py_modules=['weibo_harvester','weiboarc','weibo_warc_iter'],
+             'weibo_warc_iter.py',
+             'weibo_warc_index.py'],
+    py_modules=['weibo_harvester','weiboarc','aioweiboarc','weibo_warc_iter','weibo_seen_index',
+                'weibo_metrics','weibo_profile','weibo_warc_index'],
     install_requires=['sfmutils'],
     tests_require=['mock==2.0.0'],
     classifiers=[
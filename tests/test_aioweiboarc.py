@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import tests
+from tests.weibos import weibo6
+from mock import patch
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import asyncio
+import copy
+from aioweiboarc import AsyncWeiboarc
+
+
+def _status(weibo_id):
+    status = copy.deepcopy(weibo6)
+    status["id"] = weibo_id
+    status["mid"] = str(weibo_id)
+    return status
+
+
+class TestAsyncWeiboarc(tests.TestCase):
+    """
+    Runs AsyncWeiboarc against a local stand-in for api.weibo.com.
+    """
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.requests = []
+        self.responses = []
+        self.rate_limit_status = 200
+        app = web.Application()
+        app.router.add_get("/2/{uri:.+}.json", self._handle)
+        self.server = TestServer(app, loop=self.loop)
+        self.loop.run_until_complete(self.server.start_server())
+        self.site = str(self.server.make_url("/"))
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.server.close())
+        self.loop.close()
+
+    async def _handle(self, request):
+        uri = request.match_info["uri"]
+        self.requests.append((uri, dict(request.query)))
+        if uri == "account/rate_limit_status":
+            return web.json_response({"remaining_ip_hits": 0, "remaining_user_hits": 0,
+                                      "reset_time_in_seconds": 5}, status=self.rate_limit_status)
+        status, body = self.responses.pop(0)
+        return web.json_response(body, status=status)
+
+    def _run(self, f):
+        async def run():
+            async with AsyncWeiboarc("token", site=self.site) as weiboarc:
+                return await f(weiboarc)
+        return self.loop.run_until_complete(run())
+
+    def test_search_topic(self):
+        self.responses = [(200, {"statuses": [_status(110), _status(109)]}),
+                          (200, {"statuses": [_status(107), _status(106), _status(105)]})]
+
+        async def search(weiboarc):
+            return [status async for status in weiboarc.search_topic(u"春晚", since_id=105)]
+
+        statuses = self._run(search)
+        self.assertEqual([110, 109, 107, 106], [status["id"] for status in statuses])
+        self.assertEqual(["1", "2"], [params["page"] for uri, params in self.requests])
+        self.assertEqual("token", self.requests[0][1]["access_token"])
+
+    @patch("aioweiboarc.asyncio.sleep")
+    def test_search_friendships_retry(self, mock_sleep):
+        sleeps = []
+
+        async def sleep(seconds):
+            sleeps.append(seconds)
+        mock_sleep.side_effect = sleep
+
+        self.responses = [(403, {"error_code": 10023, "error": "User requests out of rate limit!",
+                                 "request": "/2/statuses/friends_timeline.json"}),
+                          (502, {}),
+                          (200, {"statuses": [_status(110), _status(109)]}),
+                          (200, {"statuses": []})]
+
+        async def timeline(weiboarc):
+            return [status async for status in weiboarc.search_friendships(since_id=100)]
+
+        statuses = self._run(timeline)
+        self.assertEqual([110, 109], [status["id"] for status in statuses])
+        # reset_time_in_seconds + 10 for the rate limit, then the first backoff for the 502
+        self.assertEqual(2, len(sleeps))
+        self.assertEqual(15, sleeps[0])
+        self.assertTrue(1 <= sleeps[1] <= 2)
+        self.assertEqual("108", self.requests[-1][1]["max_id"])
+
+    @patch("aioweiboarc.asyncio.sleep")
+    def test_rate_limit_status_rate_limited(self, mock_sleep):
+        sleeps = []
+
+        async def sleep(seconds):
+            sleeps.append(seconds)
+        mock_sleep.side_effect = sleep
+
+        self.rate_limit_status = 429
+        self.responses = [(429, {}),
+                          (200, {"statuses": [_status(110)]}),
+                          (200, {"statuses": []})]
+
+        async def timeline(weiboarc):
+            return [status async for status in weiboarc.search_friendships()]
+
+        self.assertEqual([110], [status["id"] for status in self._run(timeline)])
+        # the rate limit status is asked once, then the sleep is until the hourly reset
+        self.assertEqual(1, [uri for uri, params in self.requests].count("account/rate_limit_status"))
+        self.assertEqual(1, len(sleeps))
+        self.assertGreater(sleeps[0], 60)
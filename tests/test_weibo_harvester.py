@@ -11,16 +11,24 @@ from kombu import Connection, Exchange, Queue, Producer
 from sfmutils.state_store import DictHarvestStateStore
 from sfmutils.harvester import HarvestResult, EXCHANGE, STATUS_RUNNING, STATUS_SUCCESS
 from sfmutils.warc_iter import IterItem
+from warcio.archiveiterator import ArchiveIterator
+from warcio.statusandheaders import StatusAndHeaders
+from warcio.warcwriter import WARCWriter
+from io import BytesIO
 import threading
 import shutil
 import tempfile
 import time
+import tracemalloc
 import os
 import copy
+import json
 from datetime import datetime, date
 from weibo_harvester import WeiboHarvester
 from weibo_warc_iter import WeiboWarcIter
-from weiboarc import Weiboarc
+from weibo_seen_index import SeenIndex, SEEN_INDEX_FILENAME
+from weibo_profile import Profiler
+from weiboarc import Weiboarc, RetryBudgetExceeded
 
 vcr = base_vcr.VCR(
     cassette_library_dir='tests/fixtures',
@@ -68,6 +76,60 @@ base_search_message = {
 }
 
 
+TEST_WARC_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  "warcs/2/2016/04/24/17/3a3f522447d1482f8f8dd0018b00bd35-20160424170028814-00000"
+                                  "-6389-bf4e6baa25b2-8000.warc.gz")
+
+
+class SerialStateStore(DictHarvestStateStore):
+    """
+    Records the max number of threads accessing the state store at once.
+    """
+
+    def __init__(self):
+        DictHarvestStateStore.__init__(self)
+        self.concurrent = 0
+        self.max_concurrent = 0
+        self.lock = threading.Lock()
+
+    def _access(self, func, *args):
+        with self.lock:
+            self.concurrent += 1
+            self.max_concurrent = max(self.max_concurrent, self.concurrent)
+        try:
+            time.sleep(0.001)
+            return func(self, *args)
+        finally:
+            with self.lock:
+                self.concurrent -= 1
+
+    def get_state(self, resource_type, key):
+        return self._access(DictHarvestStateStore.get_state, resource_type, key)
+
+    def set_state(self, resource_type, key, value):
+        return self._access(DictHarvestStateStore.set_state, resource_type, key, value)
+
+
+def _copy_warc(working_path):
+    warc_filepath = os.path.join(working_path, "test.warc.gz")
+    shutil.copy(TEST_WARC_FILEPATH, warc_filepath)
+    return warc_filepath
+
+
+def _append_rate_limit_record(warc_filepath):
+    """
+    Append an account/rate_limit_status response to the WARC, as recorded by warcprox.
+    """
+    body = json.dumps({"ip_limit": 10000, "remaining_ip_hits": 10000, "remaining_user_hits": 150,
+                       "reset_time_in_seconds": 1200}).encode("utf-8")
+    with open(warc_filepath, "ab") as f:
+        writer = WARCWriter(f, gzip=True)
+        http_headers = StatusAndHeaders("200 OK", [("Content-Type", "application/json")], protocol="HTTP/1.1")
+        writer.write_record(writer.create_warc_record(
+            "https://api.weibo.com/2/account/rate_limit_status.json?access_token=token", "response",
+            payload=BytesIO(body), http_headers=http_headers))
+
+
 @unittest.skipIf(not tests.test_config_available, "Skipping test since test config not available.")
 class TestWeiboHarvesterVCR(tests.TestCase):
     def setUp(self):
@@ -189,6 +251,147 @@ class TestWeiboHarvester(tests.TestCase):
         self.assertEqual([call(since_id=3927348724716740)], mock_weiboarc.search_friendships.mock_calls)
         self.assertNotEqual([call(since_id=None)], mock_weiboarc.search_friendships.mock_calls)
 
+    @patch("weibo_harvester.Weiboarc", autospec=True)
+    def test_search_timeline_backfill(self, mock_weiboarc_class):
+        mock_weiboarc = MagicMock(spec=Weiboarc)
+        mock_weiboarc.backfill_friendships.side_effect = [(weibo1, weibo2)]
+        mock_weiboarc_class.side_effect = [mock_weiboarc]
+
+        self.harvester.message = copy.deepcopy(base_timeline_message)
+        self.harvester.message["options"]["backfill_windows"] = 4
+        self.harvester.message["options"]["backfill_days"] = 2
+        self.harvester.harvest_seeds()
+
+        self.assertDictEqual({"weibos": 2}, self.harvester.result.harvest_counter)
+        mock_weiboarc.search_friendships.assert_not_called()
+        start_time = mock_weiboarc.backfill_friendships.call_args[0][0]
+        self.assertAlmostEqual(time.time() - 2 * 86400, start_time, delta=60)
+        self.assertEqual(4, mock_weiboarc.backfill_friendships.call_args[1]["windows"])
+        self.assertIsNone(mock_weiboarc.backfill_friendships.call_args[1]["since_id"])
+
+    @patch("weibo_harvester.Weiboarc", autospec=True)
+    def test_search_timeline_resume(self, mock_weiboarc_class):
+        def search_friendships(since_id=None, max_id=None, on_cursor=None):
+            yield weibo2
+            on_cursor({"since_id": since_id, "max_id": "3927348724716739"})
+            # interrupted
+            self.assertEqual({"since_id": 3927348724716700, "max_id": "3927348724716739"},
+                             self.harvester.state_store.get_state("weibo_harvester", u"test_collection_set.cursor"))
+
+        mock_weiboarc = MagicMock(spec=Weiboarc)
+        mock_weiboarc.search_friendships.side_effect = search_friendships
+        mock_weiboarc_class.side_effect = [mock_weiboarc]
+
+        message = copy.deepcopy(base_timeline_message)
+        message["options"]["incremental"] = True
+        message["options"]["checkpoint_pages"] = 1
+        self.harvester.message = message
+        self.harvester.state_store.set_state("weibo_harvester", u"test_collection_set.since_id", 3927348724716800)
+        self.harvester.state_store.set_state("weibo_harvester", u"test_collection_set.cursor",
+                                             {"since_id": 3927348724716700, "max_id": "3927348724716750"})
+        self.harvester.harvest_seeds()
+
+        self.assertDictEqual({"weibos": 1}, self.harvester.result.harvest_counter)
+        # resumed from the cursor of the interrupted harvest
+        kwargs = mock_weiboarc.search_friendships.call_args[1]
+        self.assertEqual(3927348724716700, kwargs["since_id"])
+        self.assertEqual("3927348724716750", kwargs["max_id"])
+        # cleared once the harvest completed
+        self.assertIsNone(self.harvester.state_store.get_state("weibo_harvester", u"test_collection_set.cursor"))
+
+    @patch("weibo_harvester.Weiboarc", autospec=True)
+    def test_search_timeline_dedupe(self, mock_weiboarc_class):
+        weibos = []
+        for weibo_id in range(300, 0, -1):
+            weibo = copy.deepcopy(weibo1)
+            weibo["id"] = weibo_id
+            weibos.append(weibo)
+        timeline = iter(weibos)
+        mock_weiboarc = MagicMock(spec=Weiboarc)
+        mock_weiboarc.search_friendships.side_effect = [timeline]
+        mock_weiboarc_class.side_effect = [mock_weiboarc]
+        # weibos 1 to 190 seen by a previous harvest
+        index = SeenIndex(os.path.join(self.working_path, SEEN_INDEX_FILENAME))
+        for weibo_id in range(1, 191):
+            index.add(weibo_id)
+        index.save()
+
+        message = copy.deepcopy(base_timeline_message)
+        message["path"] = self.working_path
+        message["options"]["dedupe"] = True
+        message["options"]["dedupe_stop_paging"] = True
+        self.harvester.message = message
+        self.harvester.harvest_seeds()
+
+        self.assertDictEqual({"weibos": 110}, self.harvester.result.harvest_counter)
+        # stopped after a page of seen weibos
+        self.assertEqual(90, len(list(timeline)))
+        # the index is only updated by processing the WARCs
+        self.assertEqual(190, len(SeenIndex(os.path.join(self.working_path, SEEN_INDEX_FILENAME))))
+
+    @patch("weibo_harvester.Weiboarc", autospec=True)
+    def test_search_timeline_access_tokens(self, mock_weiboarc_class):
+        mock_weiboarc = MagicMock(spec=Weiboarc)
+        mock_weiboarc.search_friendships.side_effect = [(weibo1, weibo2)]
+        mock_weiboarc_class.side_effect = [mock_weiboarc]
+
+        message = copy.deepcopy(base_timeline_message)
+        message["credentials"]["access_tokens"] = [tests.WEIBO_ACCESS_TOKEN, "access_token2"]
+        self.harvester.message = message
+        self.harvester.harvest_seeds()
+
+        self.assertDictEqual({"weibos": 2}, self.harvester.result.harvest_counter)
+        mock_weiboarc_class.assert_called_once_with([tests.WEIBO_ACCESS_TOKEN, "access_token2"])
+
+    @patch("weibo_harvester.Weiboarc", autospec=True)
+    def test_search_timeline_budget_exceeded(self, mock_weiboarc_class):
+        def search_friendships(since_id=None):
+            yield weibo1
+            raise RetryBudgetExceeded("retrying for 3600s would exceed the harvest time budget")
+
+        mock_weiboarc = MagicMock(spec=Weiboarc)
+        mock_weiboarc.search_friendships.side_effect = search_friendships
+        mock_weiboarc_class.side_effect = [mock_weiboarc]
+
+        message = copy.deepcopy(base_timeline_message)
+        message["options"]["time_budget"] = 600
+        self.harvester.message = message
+        self.harvester.harvest_seeds()
+
+        self.assertDictEqual({"weibos": 1}, self.harvester.result.harvest_counter)
+        self.assertEqual(1, len(self.harvester.result.warnings))
+        retry_policy = mock_weiboarc_class.call_args[1]["retry_policy"]
+        self.assertIs(self.harvester.stop_harvest_seeds_event, retry_policy.stop_event)
+        self.assertIsNotNone(retry_policy.deadline)
+
+    @patch("weibo_harvester.Weiboarc", autospec=True)
+    def test_search_timeline_budget_exceeded_resume(self, mock_weiboarc_class):
+        def backfill_friendships(start_time, windows=4, since_id=None):
+            yield weibo1
+            raise RetryBudgetExceeded("retrying for 3600s would exceed the harvest time budget")
+
+        mock_weiboarc = MagicMock(spec=Weiboarc)
+        mock_weiboarc.backfill_friendships.side_effect = backfill_friendships
+        mock_weiboarc.search_friendships.side_effect = [(weibo2,)]
+        mock_weiboarc_class.side_effect = [mock_weiboarc, mock_weiboarc]
+
+        message = copy.deepcopy(base_timeline_message)
+        message["options"]["incremental"] = True
+        message["options"]["backfill_windows"] = 4
+        self.harvester.message = message
+        self.harvester.state_store.set_state("weibo_harvester", u"test_collection_set.since_id", 3927348724716700)
+        self.harvester.harvest_seeds()
+
+        # the weibos older than the ones harvested are left to the next harvest
+        self.assertEqual({"since_id": 3927348724716700, "max_id": int(weibo1["id"]) - 1},
+                         self.harvester.state_store.get_state("weibo_harvester", u"test_collection_set.cursor"))
+
+        self.harvester.harvest_seeds()
+
+        mock_weiboarc.search_friendships.assert_called_once_with(since_id=3927348724716700,
+                                                                 max_id=int(weibo1["id"]) - 1)
+        self.assertIsNone(self.harvester.state_store.get_state("weibo_harvester", u"test_collection_set.cursor"))
+
     @patch("weibo_harvester.Weiboarc", autospec=True)
     def test_search_topic(self, mock_weiboarc_class):
         mock_weiboarc = MagicMock(spec=Weiboarc)
@@ -227,6 +430,79 @@ class TestWeiboHarvester(tests.TestCase):
         self.assertEqual([call(query, since_id=4060927646547531)], mock_weiboarc.search_topic.mock_calls)
         self.assertDictEqual({"weibos": 1}, self.harvester.result.harvest_counter)
 
+    @patch("weibo_harvester.Weiboarc", autospec=True)
+    def test_search_topic_adaptive_depth(self, mock_weiboarc_class):
+        mock_weiboarc = MagicMock(spec=Weiboarc)
+        mock_weiboarc.search_topic.side_effect = [(weibo7,), (weibo7,)]
+        mock_weiboarc_class.return_value = mock_weiboarc
+
+        message = copy.deepcopy(base_search_message)
+        message["options"]["incremental"] = True
+        message["options"]["adaptive_depth"] = True
+        message["options"]["concurrent_search"] = True
+        self.harvester.message = message
+        self.harvester.state_store.set_state("weibo_harvester", u"春晚.since_id", 4060927646547531)
+        # 50 weibos an hour, 75 expected with the margin
+        self.harvester.state_store.set_state("weibo_harvester", u"春晚.velocity",
+                                             {"time": time.time() - 3600, "rate": 50 / 3600.0})
+        self.harvester.harvest_seeds()
+
+        self.assertEqual(2, mock_weiboarc.search_topic.call_args[1]["max_pages"])
+        velocity = self.harvester.state_store.get_state("weibo_harvester", u"春晚.velocity")
+        self.assertAlmostEqual(time.time(), velocity["time"], delta=60)
+        # a weibo since the since_id of years ago
+        self.assertLess(velocity["rate"], 50 / 3600.0)
+        self.assertEqual(["suggested_interval"], [msg.code for msg in self.harvester.result.infos])
+
+        # the serial search stops at the page of the since_id by itself
+        del message["options"]["concurrent_search"]
+        self.harvester.harvest_seeds()
+        self.assertNotIn("max_pages", mock_weiboarc.search_topic.call_args[1])
+
+    @patch("weibo_harvester.Weiboarc", autospec=True)
+    def test_search_topic_seeds(self, mock_weiboarc_class):
+        mock_weiboarc = MagicMock(spec=Weiboarc)
+        results = {u"春晚": (weibo6, weibo7), u"元宵": (weibo7,)}
+        mock_weiboarc.search_topic.side_effect = lambda query, since_id=None: results[query]
+        mock_weiboarc_class.side_effect = [mock_weiboarc]
+
+        message = copy.deepcopy(base_search_message)
+        message["seeds"].append({"id": "seed_id2", "token": u"元宵"})
+        message["options"]["incremental"] = True
+        self.harvester.message = message
+        self.harvester.state_store.set_state("weibo_harvester", u"元宵.since_id", 4060927646547531)
+        self.harvester.harvest_seeds()
+
+        self.assertDictEqual({"weibos": 3}, self.harvester.result.harvest_counter)
+        mock_weiboarc_class.assert_called_once_with(tests.WEIBO_ACCESS_TOKEN, pool_maxsize=10)
+        self.assertCountEqual([call(u"春晚", since_id=None), call(u"元宵", since_id=4060927646547531)],
+                              mock_weiboarc.search_topic.mock_calls)
+
+    @patch("weibo_harvester.Weiboarc", autospec=True)
+    def test_search_topic_seeds_state(self, mock_weiboarc_class):
+        def search_topic(query, since_id=None, on_cursor=None):
+            for max_id in range(10):
+                on_cursor({"since_id": since_id, "max_id": max_id})
+            yield weibo7
+
+        mock_weiboarc = MagicMock(spec=Weiboarc)
+        mock_weiboarc.search_topic.side_effect = search_topic
+        mock_weiboarc_class.side_effect = [mock_weiboarc]
+        self.harvester.state_store = SerialStateStore()
+
+        message = copy.deepcopy(base_search_message)
+        message["seeds"].append({"id": "seed_id2", "token": u"元宵"})
+        message["options"]["adaptive_depth"] = True
+        message["options"]["checkpoint_pages"] = 1
+        self.harvester.message = message
+        self.harvester.harvest_seeds()
+
+        # the searches do not access the state store concurrently
+        self.assertEqual(1, self.harvester.state_store.max_concurrent)
+        for query in (u"春晚", u"元宵"):
+            self.assertIsNone(self.harvester.state_store.get_state("weibo_harvester", u"{}.cursor".format(query)))
+            self.assertTrue(self.harvester.state_store.get_state("weibo_harvester", u"{}.velocity".format(query)))
+
     @staticmethod
     def _iter_items(items):
         # This is useful for mocking out a warc iter
@@ -248,7 +524,7 @@ class TestWeiboHarvester(tests.TestCase):
         self.harvester.message = base_timeline_message
         self.harvester.process_warc("test.warc.gz")
 
-        iter_class.assert_called_once_with("test.warc.gz")
+        iter_class.assert_called_once_with("test.warc.gz", lazy=True)
         self.assertEqual(3, self.harvester.result.stats_summary()["weibos"])
         # State not set
         self.assertIsNone(self.harvester.state_store.get_state("weibo_harvester", "test_collection_set.since_id"))
@@ -266,12 +542,203 @@ class TestWeiboHarvester(tests.TestCase):
         self.harvester.message = base_timeline_message
         self.harvester.process_warc("test.warc.gz")
 
-        iter_class.assert_called_once_with("test.warc.gz")
+        iter_class.assert_called_once_with("test.warc.gz", lazy=True)
         self.assertEqual(3, self.harvester.result.stats_summary()["weibos"])
         # State updated
         self.assertEqual(3973784090711192, self.harvester.state_store.get_state("weibo_harvester",
                                                                                 "test_collection_set.since_id"))
 
+    @patch("weibo_harvester.WeiboWarcIter", autospec=True)
+    def test_process_timeline_single_state_write(self, iter_class):
+        mock_iter = MagicMock(spec=WeiboWarcIter)
+        mock_iter.__iter__.side_effect = [
+            self._iter_items([weibo3, weibo4, weibo5]).__iter__()]
+        iter_class.side_effect = [mock_iter]
+
+        self.harvester.incremental = True
+        self.harvester.state_store = MagicMock(wraps=DictHarvestStateStore())
+        self.harvester.message = base_timeline_message
+        self.harvester.process_warc("test.warc.gz")
+
+        self.assertEqual(3, self.harvester.result.stats_summary()["weibos"])
+        self.harvester.state_store.get_state.assert_called_once_with("weibo_harvester",
+                                                                     "test_collection_set.since_id")
+        self.harvester.state_store.set_state.assert_called_once_with("weibo_harvester",
+                                                                     "test_collection_set.since_id",
+                                                                     3973784090711192)
+
+    def test_process_timeline_summaries(self):
+        # the rate limit status has no summary, as it is not a page of statuses
+        warc_filepath = _copy_warc(self.working_path)
+        _append_rate_limit_record(warc_filepath)
+        # the pages as seen by the harvest
+        self.harvester.page_summaries = {}
+        pages = {}
+        with open(TEST_WARC_FILEPATH, "rb") as f:
+            for record in ArchiveIterator(f):
+                if record.rec_type == "response":
+                    pages[record.rec_headers.get_header("WARC-Target-URI")] = json.loads(
+                        record.content_stream().read().decode("utf-8"))["statuses"]
+        for url, statuses in pages.items():
+            self.harvester._summarize_page(url, statuses)
+
+        self.harvester.incremental = True
+        self.harvester.message = base_timeline_message
+        with patch("weibo_harvester.WeiboWarcIter", autospec=True) as iter_class:
+            self.harvester.process_warc(warc_filepath)
+            iter_class.assert_not_called()
+
+        self.assertEqual(sum(len(statuses) for statuses in pages.values()),
+                         self.harvester.result.stats_summary()["weibos"])
+        self.assertEqual(max(status["id"] for statuses in pages.values() for status in statuses),
+                         self.harvester.state_store.get_state("weibo_harvester", "test_collection_set.since_id"))
+
+        # falls back to parsing the WARC when a page has no summary
+        del self.harvester.page_summaries[list(pages)[0]]
+        with patch("weibo_harvester.WeiboWarcIter", autospec=True) as iter_class:
+            iter_class.return_value.__iter__.return_value = iter([])
+            self.harvester.process_warc(warc_filepath)
+            iter_class.assert_called_once_with(warc_filepath, lazy=True)
+
+    def test_process_timeline_rate_limit_record(self):
+        # the first request of a paced harvest is for the rate limit status
+        warc_filepath = _copy_warc(self.working_path)
+        _append_rate_limit_record(warc_filepath)
+
+        self.harvester.incremental = True
+        self.harvester.message = copy.deepcopy(base_timeline_message)
+        self.harvester.message["options"]["pace_requests"] = True
+        self.harvester.process_warc(warc_filepath)
+
+        weibo_ids = {item.id for item in WeiboWarcIter(TEST_WARC_FILEPATH)}
+        self.assertTrue(weibo_ids)
+        self.assertEqual(len(weibo_ids), self.harvester.result.stats_summary()["weibos"])
+
+    def test_process_timeline_warc_workers(self):
+        warc_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "warcs/2/2016/04/24/17")
+        warc_filepaths = [os.path.join(warc_path, filename) for filename in sorted(os.listdir(warc_path))]
+
+        self.harvester.incremental = True
+        self.harvester.message = base_timeline_message
+        for warc_filepath in warc_filepaths:
+            self.harvester.process_warc(warc_filepath)
+
+        harvester = WeiboHarvester(self.working_path)
+        harvester.state_store = DictHarvestStateStore()
+        harvester.result = HarvestResult()
+        harvester.incremental = True
+        harvester.message = copy.deepcopy(base_timeline_message)
+        harvester.message["options"]["warc_workers"] = 2
+        for warc_filepath in warc_filepaths:
+            harvester.process_warc(warc_filepath)
+
+        self.assertTrue(self.harvester.result.stats_summary()["weibos"])
+        self.assertEqual(self.harvester.result.stats_summary(), harvester.result.stats_summary())
+        self.assertEqual(self.harvester.state_store.get_state("weibo_harvester", "test_collection_set.since_id"),
+                         harvester.state_store.get_state("weibo_harvester", "test_collection_set.since_id"))
+        self.assertIsNone(harvester._warc_pool)
+
+    def test_process_timeline_warc_workers_siblings(self):
+        # the rotated WARCs of a harvest, next to the WARC of another harvest
+        filenames = ["harvest1-20160424170028814-00000-6389-bf4e6baa25b2-8000.warc.gz",
+                     "harvest1-20160424171028814-00001-6389-bf4e6baa25b2-8000.warc.gz",
+                     "harvest2-20160424170528814-00000-6398-bf4e6baa25b2-8000.warc.gz"]
+        warc_filepaths = [os.path.join(self.working_path, filename) for filename in filenames]
+        for warc_filepath in warc_filepaths:
+            shutil.copy(TEST_WARC_FILEPATH, warc_filepath)
+
+        self.harvester.message = copy.deepcopy(base_timeline_message)
+        self.harvester.message["options"]["warc_workers"] = 2
+        self.harvester.process_warc(warc_filepaths[0])
+        self.assertEqual([warc_filepaths[1]], list(self.harvester._warc_scans))
+        self.harvester.process_warc(warc_filepaths[1])
+        self.assertEqual({}, self.harvester._warc_scans)
+        self.assertIsNone(self.harvester._warc_pool)
+
+    @patch("weibo_harvester.WeiboWarcIter", autospec=True)
+    def test_process_search_topic_dedupe(self, iter_class):
+        mock_iter = MagicMock(spec=WeiboWarcIter)
+        mock_iter.__iter__.side_effect = [
+            self._iter_items([weibo6, weibo7, weibo6]).__iter__(),
+            self._iter_items([weibo7]).__iter__()]
+        iter_class.side_effect = [mock_iter, mock_iter]
+
+        self.harvester.message = copy.deepcopy(base_search_message)
+        self.harvester.message["path"] = self.working_path
+        self.harvester.message["options"]["dedupe"] = True
+        self.harvester.process_warc("test1.warc.gz")
+        self.harvester.process_warc("test2.warc.gz")
+
+        self.assertDictEqual({"weibos": 2}, self.harvester.result.stats_summary())
+        self.assertEqual(2, len(SeenIndex(os.path.join(self.working_path, SEEN_INDEX_FILENAME))))
+
+    @patch("weibo_harvester.Weiboarc", autospec=True)
+    @patch("weibo_harvester.WeiboWarcIter", autospec=True)
+    def test_process_search_topic_dedupe_reload(self, iter_class, mock_weiboarc_class):
+        mock_iter = MagicMock(spec=WeiboWarcIter)
+        mock_iter.__iter__.side_effect = [
+            self._iter_items([weibo6]).__iter__(),
+            self._iter_items([weibo7]).__iter__()]
+        iter_class.side_effect = [mock_iter, mock_iter]
+        mock_weiboarc = MagicMock(spec=Weiboarc)
+        mock_weiboarc.search_topic.return_value = ()
+        mock_weiboarc_class.return_value = mock_weiboarc
+
+        self.harvester.message = copy.deepcopy(base_search_message)
+        self.harvester.message["path"] = self.working_path
+        self.harvester.message["options"]["dedupe"] = True
+        self.harvester.process_warc("test1.warc.gz")
+        # saved by another harvester of the collection set
+        index = SeenIndex(os.path.join(self.working_path, SEEN_INDEX_FILENAME))
+        index.add(weibo7["id"])
+        index.save()
+
+        self.harvester.harvest_seeds()
+        self.harvester.process_warc("test2.warc.gz")
+
+        self.assertDictEqual({"weibos": 1}, self.harvester.result.stats_summary())
+        self.assertEqual(2, len(SeenIndex(os.path.join(self.working_path, SEEN_INDEX_FILENAME))))
+
+    def test_process_timeline_profile(self):
+        warc_filepath = os.path.join(self.working_path, "test.warc.gz")
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "warcs/2/2016/04/24/17/3a3f522447d1482f8f8dd0018b00bd35-20160424170028814-00000"
+                                 "-6389-bf4e6baa25b2-8000.warc.gz"), warc_filepath)
+        self.harvester.message = copy.deepcopy(base_timeline_message)
+        self.harvester.message["options"]["profile"] = "timers"
+
+        with patch("weibo_profile.profiler", Profiler()) as profiler, patch("weibo_harvester.profiler", profiler), \
+                patch("weibo_warc_iter.profiler", profiler):
+            self.harvester.process_warc(warc_filepath)
+
+        with open(os.path.join(self.working_path, "test_1.profile.json")) as f:
+            stages = json.load(f)
+        self.assertEqual(1, stages["process_warc"]["calls"])
+        self.assertIn("warc_iter", stages)
+
+    @patch("weibo_harvester.Weiboarc", autospec=True)
+    def test_search_timeline_profile_scoped(self, mock_weiboarc_class):
+        mock_weiboarc = MagicMock(spec=Weiboarc)
+        mock_weiboarc.search_friendships.side_effect = [(weibo1,), (weibo2,), (weibo2,)]
+        mock_weiboarc_class.return_value = mock_weiboarc
+        profiled_message = copy.deepcopy(base_timeline_message)
+        profiled_message["options"]["profile"] = "tracemalloc"
+
+        with patch("weibo_profile.profiler", Profiler()) as profiler, patch("weibo_harvester.profiler", profiler):
+            self.harvester.message = profiled_message
+            self.harvester.harvest_seeds()
+            self.assertTrue(tracemalloc.is_tracing())
+            self.harvester.harvest_seeds()
+            # only the stages of the last harvest
+            self.assertEqual(1, profiler.stages["friends_timeline"]["calls"])
+
+            # the modes of the option are disabled by the next harvest
+            self.harvester.message = base_timeline_message
+            self.harvester.harvest_seeds()
+            self.assertFalse(profiler.enabled)
+            self.assertFalse(tracemalloc.is_tracing())
+            self.assertEqual({}, profiler.stages)
+
     @patch("weibo_harvester.WeiboWarcIter", autospec=True)
     def test_process_search_topic(self, iter_class):
         mock_iter = MagicMock(spec=WeiboWarcIter)
@@ -282,7 +749,7 @@ class TestWeiboHarvester(tests.TestCase):
         self.harvester.message = base_search_message
         self.harvester.process_warc("test.warc.gz")
         self.assertDictEqual({"weibos": 2}, self.harvester.result.stats_summary())
-        iter_class.assert_called_once_with("test.warc.gz")
+        iter_class.assert_called_once_with("test.warc.gz", lazy=True)
         # State updated
         query = self.harvester.message["seeds"][0]["token"]
         self.assertEqual(None, self.harvester.state_store.get_state("weibo_harvester", u"{}.since_id".format(query)))
@@ -304,11 +771,51 @@ class TestWeiboHarvester(tests.TestCase):
 
         self.assertDictEqual({"weibos": 2}, self.harvester.result.stats_summary())
 
-        iter_class.assert_called_once_with("test.warc.gz")
+        iter_class.assert_called_once_with("test.warc.gz", lazy=True)
         # State updated
         self.assertEqual(4060928330955796,
                          self.harvester.state_store.get_state("weibo_harvester", u"{}.since_id".format(query)))
 
+    @patch("weibo_harvester.WeiboWarcIter", autospec=True)
+    def test_process_search_topic_seeds(self, iter_class):
+        mock_iter = MagicMock(spec=WeiboWarcIter)
+        mock_iter.__iter__.side_effect = [[
+            IterItem(None, None, None, "https://api.weibo.com/2/search/topics.json?count=50&q=%E6%98%A5%E6%99%9A"
+                                       "&page=1&access_token=token", weibo7),
+            IterItem(None, None, None, "https://api.weibo.com/2/search/topics.json?count=50&q=%E5%85%83%E5%AE%B5"
+                                       "&page=1&access_token=token", weibo6)].__iter__()]
+        iter_class.side_effect = [mock_iter]
+
+        message = copy.deepcopy(base_search_message)
+        message["seeds"].append({"id": "seed_id2", "token": u"元宵"})
+        self.harvester.message = message
+        self.harvester.incremental = True
+        self.harvester.process_warc("test.warc.gz")
+
+        self.assertDictEqual({"weibos": 2}, self.harvester.result.stats_summary())
+        # each query has its own since_id
+        self.assertEqual(4060928330955796, self.harvester.state_store.get_state("weibo_harvester", u"春晚.since_id"))
+        self.assertEqual(4060927646547531, self.harvester.state_store.get_state("weibo_harvester", u"元宵.since_id"))
+
+    @patch("weibo_harvester.WeiboWarcIter", autospec=True)
+    def test_process_search_topic_single_state_write(self, iter_class):
+        mock_iter = MagicMock(spec=WeiboWarcIter)
+        mock_iter.__iter__.side_effect = [
+            self._iter_items([weibo7, weibo6, weibo7]).__iter__()]
+        iter_class.side_effect = [mock_iter]
+
+        self.harvester.message = base_search_message
+        self.harvester.incremental = True
+        self.harvester.state_store = MagicMock(wraps=DictHarvestStateStore())
+        self.harvester.state_store.set_state("weibo_harvester", u"春晚.since_id", 4060927646547530)
+        self.harvester.state_store.reset_mock()
+        self.harvester.process_warc("test.warc.gz")
+
+        self.assertDictEqual({"weibos": 3}, self.harvester.result.stats_summary())
+        self.harvester.state_store.get_state.assert_called_once_with("weibo_harvester", u"春晚.since_id")
+        self.harvester.state_store.set_state.assert_called_once_with("weibo_harvester", u"春晚.since_id",
+                                                                     4060928330955796)
+
 
 @unittest.skipIf(not tests.test_config_available, "Skipping test since test config not available.")
 @unittest.skipIf(not tests.integration_env_available, "Skipping test since integration env not available.")
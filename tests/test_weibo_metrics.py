@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import tests
+import os
+import shutil
+import tempfile
+from urllib.request import urlopen
+from mock import MagicMock
+from weibo_metrics import Metrics, metrics
+from weiboarc import Client
+
+
+class TestMetrics(tests.TestCase):
+    def test_render(self):
+        registry = Metrics(buckets=(0.1, 1))
+        registry.inc("weibo_api_requests_total", endpoint="search/topics", status=200)
+        registry.inc("weibo_api_requests_total", endpoint="search/topics", status=200)
+        registry.set("weibo_harvested_statuses_per_second", 2.5, type="weibo_search")
+        registry.observe("weibo_api_request_seconds", 0.5, endpoint="search/topics")
+
+        self.assertEqual(2, registry.value("weibo_api_requests_total", endpoint="search/topics", status=200))
+        self.assertEqual("\n".join([
+            '# TYPE weibo_api_requests_total counter',
+            'weibo_api_requests_total{endpoint="search/topics",status="200"} 2',
+            '# TYPE weibo_harvested_statuses_per_second gauge',
+            'weibo_harvested_statuses_per_second{type="weibo_search"} 2.5',
+            '# TYPE weibo_api_request_seconds histogram',
+            'weibo_api_request_seconds_bucket{endpoint="search/topics",le="0.1"} 0',
+            'weibo_api_request_seconds_bucket{endpoint="search/topics",le="1"} 1',
+            'weibo_api_request_seconds_bucket{endpoint="search/topics",le="+Inf"} 1',
+            'weibo_api_request_seconds_sum{endpoint="search/topics"} 0.5',
+            'weibo_api_request_seconds_count{endpoint="search/topics"} 1',
+            '']), registry.render())
+
+    def test_dump(self):
+        working_path = tempfile.mkdtemp()
+        try:
+            registry = Metrics()
+            registry.inc("weibo_harvested_statuses_total", 3, type="weibo_timeline")
+            filepath = os.path.join(working_path, "metrics.prom")
+            registry.dump(filepath)
+            with open(filepath) as f:
+                self.assertIn('weibo_harvested_statuses_total{type="weibo_timeline"} 3', f.read())
+        finally:
+            shutil.rmtree(working_path)
+
+    def test_serve(self):
+        registry = Metrics()
+        registry.inc("weibo_api_retries_total", kind="server_error", code=502)
+        server = registry.serve(0)
+        try:
+            body = urlopen("http://localhost:{}/metrics".format(server.server_address[1])).read().decode("utf-8")
+            self.assertIn('weibo_api_retries_total{code="502",kind="server_error"} 1', body)
+        finally:
+            registry.shutdown()
+
+    def test_client(self):
+        metrics.reset()
+        client = Client("token")
+        client.session = MagicMock()
+        client.session.get.return_value = MagicMock(status_code=200, content=b'{"statuses": []}')
+
+        client.get("statuses/friends_timeline", count=100)
+
+        self.assertEqual(1, metrics.value("weibo_api_requests_total", endpoint="statuses/friends_timeline",
+                                          status=200))
+        self.assertEqual(1, metrics.value("weibo_api_request_seconds", endpoint="statuses/friends_timeline"))
+        self.assertEqual(16, metrics.value("weibo_api_received_bytes_total", endpoint="statuses/friends_timeline"))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import tests
+import json
+import os
+import pstats
+import shutil
+import tempfile
+import tracemalloc
+from weibo_profile import Profiler
+
+
+class TestProfiler(tests.TestCase):
+    def setUp(self):
+        self.working_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        if os.path.exists(self.working_path):
+            shutil.rmtree(self.working_path)
+
+    def test_disabled(self):
+        profiler = Profiler()
+        with profiler.stage("harvest"):
+            pass
+        self.assertEqual({}, profiler.stages)
+        self.assertEqual([], profiler.write(self.working_path))
+
+    def test_stages(self):
+        profiler = Profiler(["timers"])
+        with profiler.stage("harvest"):
+            with profiler.stage("page"):
+                sum(range(1000))
+        self.assertEqual(["a", "b"], list(profiler.iterate("iter", iter(["a", "b"]))))
+
+        self.assertEqual(1, profiler.stages["harvest"]["calls"])
+        self.assertEqual(1, profiler.stages["page"]["calls"])
+        # the last call finds the end of the items
+        self.assertEqual(3, profiler.stages["iter"]["calls"])
+        self.assertGreaterEqual(profiler.stages["harvest"]["wall"], profiler.stages["page"]["wall"])
+
+    def test_write(self):
+        profiler = Profiler(["cprofile"])
+        with profiler.stage("harvest"):
+            sum(range(1000))
+
+        filepaths = profiler.write(self.working_path, "test:1")
+
+        self.assertEqual([os.path.join(self.working_path, "test_1.profile.json"),
+                          os.path.join(self.working_path, "test_1.prof")], filepaths)
+        with open(filepaths[0]) as f:
+            self.assertEqual(1, json.load(f)["harvest"]["calls"])
+        self.assertTrue(pstats.Stats(filepaths[1]).total_calls)
+
+    def test_disable(self):
+        profiler = Profiler(["cprofile"])
+        with profiler.stage("harvest"):
+            pass
+        profiler.reset()
+        self.assertEqual({}, profiler.stages)
+
+        profiler.enable(["tracemalloc"])
+        profiler.disable(["tracemalloc", "cprofile"])
+        self.assertEqual({"timers"}, profiler.modes)
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertEqual([os.path.join(self.working_path, "weibo.profile.json")], profiler.write(self.working_path))
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, Profiler, ["perf"])
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import tests
+import os
+import shutil
+import tempfile
+from weibo_seen_index import SeenIndex
+
+
+class TestSeenIndex(tests.TestCase):
+    def setUp(self):
+        self.working_path = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.working_path, "seen.bin")
+
+    def tearDown(self):
+        if os.path.exists(self.working_path):
+            shutil.rmtree(self.working_path)
+
+    def test_add(self):
+        index = SeenIndex(self.filepath)
+        self.assertTrue(index.add(4060928330955796))
+        self.assertFalse(index.add(4060928330955796))
+        self.assertIn(4060928330955796, index)
+        self.assertNotIn(4060927646547531, index)
+
+    def test_save(self):
+        index = SeenIndex(self.filepath)
+        for weibo_id in (3, 1, 2):
+            index.add(weibo_id)
+        index.save()
+        index.add(0)
+        index.save()
+        self.assertEqual(4 * 8, os.path.getsize(self.filepath))
+
+        index = SeenIndex(self.filepath)
+        self.assertEqual([0, 1, 2, 3], list(index.ids))
+        self.assertFalse(index.add(2))
+        self.assertTrue(index.add(4))
+
+    def test_memory(self):
+        index = SeenIndex()
+        index.add(1)
+        index.save()
+        self.assertEqual(1, len(index))
+        self.assertFalse(os.listdir(self.working_path))
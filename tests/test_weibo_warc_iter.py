@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import tests
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import timedelta
+from mock import patch
+from dateutil.parser import parse as date_parse
+from weibo_warc_iter import WeiboWarcIter, parse_created_at, build_index, load_index, index_filepath, simdjson
+
+WARC_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "warcs/2/2016/04/24/17/3a3f522447d1482f8f8dd0018b00bd35-20160424170028814-00000"
+                             "-6389-bf4e6baa25b2-8000.warc.gz")
+
+
+class TestWeiboWarcIter(tests.TestCase):
+    def test_parse_created_at(self):
+        for created_at in ("Fri Jan 06 14:27:41 +0800 2017", "Sun Jan 03 23:52:45 -0530 2016",
+                           "2016-01-03T23:52:45+08:00"):
+            self.assertEqual(str(date_parse(created_at)), str(parse_created_at(created_at)))
+
+    def test_iter(self):
+        items = list(WeiboWarcIter(WARC_FILEPATH))
+        self.assertTrue(items)
+        for item in items:
+            self.assertEqual("weibo_status", item.type)
+            self.assertEqual(date_parse(item.item["created_at"]), item.date)
+
+    def test_iter_pushdown(self):
+        items = list(WeiboWarcIter(WARC_FILEPATH))
+        dates = sorted(item.date for item in items)
+        start, end = dates[len(dates) // 3], dates[2 * len(dates) // 3]
+        user_ids = [items[-1].item["user"]["idstr"]]
+
+        self.assertEqual([item for item in items if start <= item.date <= end],
+                         list(WeiboWarcIter(WARC_FILEPATH).iter(item_date_start=start, item_date_end=end)))
+        self.assertEqual([item for item in items if item.item["user"]["idstr"] in user_ids],
+                         list(WeiboWarcIter(WARC_FILEPATH, limit_user_ids=user_ids)))
+
+        # the pages out of the date range are rejected before their statuses are iterated
+        with patch.object(WeiboWarcIter, "_item_iter") as item_iter:
+            self.assertEqual([], list(WeiboWarcIter(WARC_FILEPATH).iter(
+                item_date_start=dates[-1] + timedelta(seconds=1))))
+            item_iter.assert_not_called()
+        with patch.object(WeiboWarcIter, "_item_iter") as item_iter:
+            self.assertEqual([], list(WeiboWarcIter(WARC_FILEPATH, limit_user_ids=["0"])))
+            item_iter.assert_not_called()
+
+    def test_iter_parallel(self):
+        warc_filepaths = sorted(glob.glob(os.path.join(os.path.dirname(WARC_FILEPATH), "*.warc.gz")))
+        items = list(WeiboWarcIter(warc_filepaths))
+        self.assertTrue(items)
+
+        arrival = list(WeiboWarcIter(warc_filepaths, workers=2))
+        self.assertEqual(sorted(items, key=lambda item: item.id), sorted(arrival, key=lambda item: item.id))
+
+        spill_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spill_path)
+        # the processes are forked with the temporary directory
+        with patch("tempfile.tempdir", spill_path):
+            merged = list(WeiboWarcIter(warc_filepaths, workers=2, order="created_at").iter(dedupe=True))
+            for _ in WeiboWarcIter(warc_filepaths, workers=2, order="created_at"):
+                break
+        self.assertEqual(sorted(item.date for item in items), [item.date for item in merged])
+        self.assertEqual(len({item.id for item in items}), len(merged))
+        # the sorted items spilled by the processes are removed
+        self.assertEqual([], os.listdir(spill_path))
+
+        # stopping early does not wait for all the items
+        for _ in WeiboWarcIter(warc_filepaths, workers=2):
+            break
+
+    @unittest.skipIf(simdjson is None, "pysimdjson is not installed")
+    def test_iter_lazy(self):
+        items = list(WeiboWarcIter(WARC_FILEPATH))
+        lazy = list(WeiboWarcIter(WARC_FILEPATH, lazy=True))
+        self.assertNotIsInstance(lazy[0].item, dict)
+        self.assertEqual([(item.id, item.date, item.url) for item in items],
+                         [(item.id, item.date, item.url) for item in lazy])
+        self.assertEqual([item.item for item in items], [item.item.as_dict() for item in lazy])
+
+
+class TestWeiboWarcIterIndex(tests.TestCase):
+    def setUp(self):
+        self.working_path = tempfile.mkdtemp()
+        self.warc_filepath = os.path.join(self.working_path, "test.warc.gz")
+        shutil.copy(WARC_FILEPATH, self.warc_filepath)
+
+    def tearDown(self):
+        if os.path.exists(self.working_path):
+            shutil.rmtree(self.working_path)
+
+    def test_build_index(self):
+        self.assertIsNone(load_index(self.warc_filepath))
+        index = build_index(self.warc_filepath)
+
+        self.assertTrue(os.path.exists(index_filepath(self.warc_filepath)))
+        self.assertEqual(index, load_index(self.warc_filepath))
+        entries = [entry for entry in index["records"] if "min_id" in entry]
+        self.assertTrue(entries)
+        for entry in entries:
+            self.assertLessEqual(entry["min_id"], entry["max_id"])
+            self.assertLessEqual(entry["min_time"], entry["max_time"])
+
+        # stale once the WARC changes
+        with open(self.warc_filepath, "ab") as f:
+            f.write(b"\0")
+        self.assertIsNone(load_index(self.warc_filepath))
+
+    def test_iter_index(self):
+        items = list(WeiboWarcIter(self.warc_filepath))
+        dates = sorted(item.date for item in items)
+        start, end = dates[len(dates) // 3], dates[2 * len(dates) // 3]
+        user_ids = [items[0].item["user"]["idstr"]]
+        expected = [list(WeiboWarcIter(self.warc_filepath).iter(item_date_start=start, item_date_end=end,
+                                                                dedupe=True)),
+                    list(WeiboWarcIter(self.warc_filepath, limit_user_ids=user_ids))]
+
+        build_index(self.warc_filepath)
+        self.assertEqual(items, list(WeiboWarcIter(self.warc_filepath)))
+        self.assertEqual(expected, [list(WeiboWarcIter(self.warc_filepath).iter(item_date_start=start,
+                                                                                item_date_end=end, dedupe=True)),
+                                    list(WeiboWarcIter(self.warc_filepath, limit_user_ids=user_ids))])
+
+        # no record read out of the date range
+        with patch("weibo_warc_iter.ArchiveIterator") as archive_iterator_class:
+            self.assertEqual([], list(WeiboWarcIter(self.warc_filepath).iter(
+                item_date_start=dates[-1] + timedelta(seconds=1))))
+            archive_iterator_class.assert_not_called()
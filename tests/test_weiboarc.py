@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import tests
+from tests.weibos import weibo6, weibo7
+from mock import MagicMock, patch
+import copy
+import io
+import json
+import socket
+import time
+import requests
+from weiboarc import Weiboarc, Client, WeiboResponse, WeiboStreamResponse, TokenBucket, RateLimitState, RetryPolicy, RetryBudgetExceeded, \
+    KeepAliveAdapter, APIError, RATE_LIMIT_URL, BACKFILL_QUEUE_PAGES, weibo_id_time, time_weibo_id
+
+
+def _status(weibo_id):
+    status = copy.deepcopy(weibo6)
+    status["id"] = weibo_id
+    status["mid"] = str(weibo_id)
+    return status
+
+
+def _response(statuses):
+    return WeiboResponse(MagicMock(), 200, json.dumps({"statuses": statuses}).encode("utf-8"))
+
+
+class TestWeiboarc(tests.TestCase):
+    @patch("weiboarc.Client", autospec=True)
+    def test_search_topic_concurrent(self, mock_client_class):
+        pages = {
+            1: [_status(110), _status(109), _status(108)],
+            # 108 shifted to the second page by a new weibo
+            2: [_status(108), _status(107), _status(106)],
+            3: [_status(105), _status(104)],
+            4: []
+        }
+        mock_client = mock_client_class.return_value
+        mock_client.get.side_effect = lambda url, **params: _response(pages[params["page"]])
+
+        weiboarc = Weiboarc("token", concurrent_search=True)
+        statuses = list(weiboarc.search_topic(u"春晚", since_id=104, max_id=110))
+
+        self.assertEqual([109, 108, 107, 106, 105], [status["id"] for status in statuses])
+        self.assertEqual(4, mock_client.get.call_count)
+        self.assertSetEqual({1, 2, 3, 4}, {c[1]["page"] for c in mock_client.get.call_args_list})
+
+    @patch("weiboarc.Client", autospec=True)
+    def test_on_page(self, mock_client_class):
+        pages = [_response([_status(110), _status(109)]), _response([])]
+        mock_client = mock_client_class.return_value
+        mock_client.get.side_effect = pages
+        fetched = []
+
+        weiboarc = Weiboarc("token", on_page=lambda url, statuses: fetched.append((url, statuses)))
+        list(weiboarc.search_friendships())
+
+        self.assertEqual([(pages[0].url, [_status(110), _status(109)]), (pages[1].url, [])], fetched)
+
+    @patch("weiboarc.Client", autospec=True)
+    def test_backfill_friendships(self, mock_client_class):
+        start_time = weibo_id_time(weibo6["id"])
+        # a weibo every minute for 10 hours
+        ids = [time_weibo_id(start_time + 60 * minute) + 7 for minute in range(600)]
+
+        def friends_timeline(url, **params):
+            statuses = [weibo_id for weibo_id in reversed(ids) if weibo_id > int(params.get("since_id", 0))
+                        and weibo_id <= int(params.get("max_id", ids[-1]))]
+            return _response([_status(weibo_id) for weibo_id in statuses[:params["count"]]])
+
+        mock_client = mock_client_class.return_value
+        mock_client.get.side_effect = friends_timeline
+
+        weiboarc = Weiboarc("token")
+        statuses = list(weiboarc.backfill_friendships(start_time, windows=4, since_id=ids[0],
+                                                      end_time=start_time + 36000))
+
+        self.assertEqual(list(reversed(ids[1:])), [status["id"] for status in statuses])
+        # the windows keep their own since_id
+        self.assertEqual(4, len({c[1]["since_id"] for c in mock_client.get.call_args_list}))
+
+    @patch("weiboarc.Client", autospec=True)
+    def test_backfill_friendships_close(self, mock_client_class):
+        start_time = weibo_id_time(weibo6["id"])
+        # a weibo every 6 seconds for 10 hours, 30 pages for each window
+        ids = [time_weibo_id(start_time + 6 * i) + 7 for i in range(6000)]
+
+        def friends_timeline(url, **params):
+            statuses = [weibo_id for weibo_id in reversed(ids) if weibo_id > int(params.get("since_id", 0))
+                        and weibo_id <= int(params.get("max_id", ids[-1]))]
+            return _response([_status(weibo_id) for weibo_id in statuses[:params["count"]]])
+
+        mock_client = mock_client_class.return_value
+        mock_client.get.side_effect = friends_timeline
+
+        weiboarc = Weiboarc("token")
+        statuses = weiboarc.backfill_friendships(start_time, windows=2, end_time=start_time + 36000)
+        self.assertEqual(ids[-1], next(statuses)["id"])
+        statuses.close()
+
+        # the windows only ran a few pages ahead, then stopped
+        time.sleep(0.5)
+        requests = mock_client.get.call_count
+        self.assertLess(requests, 2 * (BACKFILL_QUEUE_PAGES + 2))
+        time.sleep(0.3)
+        self.assertEqual(requests, mock_client.get.call_count)
+
+    @patch("weiboarc.Client", autospec=True)
+    def test_search_topic_resume(self, mock_client_class):
+        # the weibos posted since the interrupted search pushed its max_id to page 3
+        pages = {
+            1: [_status(114), _status(113)],
+            2: [_status(112), _status(111)],
+            3: [_status(110), _status(108), _status(107)],
+            4: [_status(105), _status(104)]
+        }
+        mock_client = mock_client_class.return_value
+        mock_client.get.side_effect = lambda url, **params: _response(pages[params["page"]])
+        cursors = []
+
+        weiboarc = Weiboarc("token")
+        statuses = list(weiboarc.search_topic(u"春晚", since_id=100, max_id=110, on_cursor=cursors.append))
+
+        self.assertEqual([108, 107, 105, 104], [status["id"] for status in statuses])
+        self.assertEqual([{"since_id": 100, "max_id": 106}, {"since_id": 100, "max_id": 103}], cursors)
+
+    @patch("weiboarc.Client", autospec=True)
+    def test_search_topic_max_pages(self, mock_client_class):
+        mock_client = mock_client_class.return_value
+        mock_client.get.side_effect = lambda url, **params: _response([_status(120 - 3 * params["page"]),
+                                                                        _status(119 - 3 * params["page"])])
+
+        weiboarc = Weiboarc("token")
+        statuses = list(weiboarc.search_topic(u"春晚", max_pages=2))
+
+        self.assertEqual([117, 116, 114, 113], [status["id"] for status in statuses])
+        self.assertEqual(2, mock_client.get.call_count)
+
+    def test_weibo_id_time(self):
+        self.assertEqual(1483684062, weibo_id_time(weibo6["id"]))
+        self.assertEqual(1483684062, weibo_id_time(time_weibo_id(1483684062)))
+
+    @patch("weiboarc.Client", autospec=True)
+    def test_search_topic_concurrent_max_pages(self, mock_client_class):
+        mock_client = mock_client_class.return_value
+        mock_client.get.side_effect = lambda url, **params: _response([_status(120 - 3 * params["page"]),
+                                                                        _status(119 - 3 * params["page"])])
+
+        weiboarc = Weiboarc("token", concurrent_search=True)
+        statuses = list(weiboarc.search_topic(u"春晚", since_id=114, max_pages=2))
+        self.assertEqual([117, 116], [status["id"] for status in statuses])
+        self.assertEqual(2, mock_client.get.call_count)
+
+        # the since_id is not reached in the 2 pages, the other pages are requested too
+        mock_client.get.reset_mock()
+        statuses = list(weiboarc.search_topic(u"春晚", since_id=107, max_pages=2))
+        self.assertEqual([117, 116, 114, 113, 111, 110, 108], [status["id"] for status in statuses])
+        self.assertEqual(4, mock_client.get.call_count)
+
+    @patch("weiboarc.Client", autospec=True)
+    def test_search_topic_concurrent_empty(self, mock_client_class):
+        mock_client = mock_client_class.return_value
+        mock_client.get.side_effect = lambda url, **params: _response([])
+
+        weiboarc = Weiboarc("token", concurrent_search=True)
+        self.assertEqual([], list(weiboarc.search_topic(u"春晚")))
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestTokenBucket(tests.TestCase):
+    def test_pacing(self):
+        clock = FakeClock()
+        rate_limit = MagicMock(return_value={"remaining_ip_hits": 1000, "remaining_user_hits": 12,
+                                             "reset_time_in_seconds": 100})
+        bucket = TokenBucket(rate_limit, burst=2, clock=clock, sleep=clock.sleep)
+
+        # the burst is free, then the 10 hits left are spread over 100 seconds
+        self.assertEqual(0, bucket.acquire())
+        self.assertEqual(0, bucket.acquire())
+        self.assertAlmostEqual(10, bucket.acquire())
+        self.assertAlmostEqual(10, bucket.acquire())
+        # idle time refills up to the burst
+        clock.now += 25
+        self.assertEqual(0, bucket.acquire())
+        self.assertEqual(0, bucket.acquire())
+        self.assertAlmostEqual(10, bucket.acquire())
+        rate_limit.assert_called_once_with()
+
+    def test_exhausted(self):
+        clock = FakeClock()
+        rate_limit = MagicMock(side_effect=[
+            {"remaining_ip_hits": 1000, "remaining_user_hits": 0, "reset_time_in_seconds": 300},
+            {"remaining_ip_hits": 1000, "remaining_user_hits": 150, "reset_time_in_seconds": 3600}])
+        bucket = TokenBucket(rate_limit, clock=clock, sleep=clock.sleep)
+
+        # sleeps until the window resets, then reseeds
+        self.assertEqual(300, bucket.acquire())
+        self.assertEqual(0, bucket.acquire())
+        self.assertEqual(2, rate_limit.call_count)
+
+    @patch("weiboarc.Client", autospec=True)
+    def test_weiboarc_pace(self, mock_client_class):
+        rate_limit = MagicMock()
+        rate_limit.status_code = 200
+        rate_limit.json.return_value = {"remaining_ip_hits": 1000, "remaining_user_hits": 150,
+                                        "reset_time_in_seconds": 3600}
+        mock_client = mock_client_class.return_value
+        mock_client.get.side_effect = lambda url, **params: rate_limit if url == RATE_LIMIT_URL else _response([])
+
+        weiboarc = Weiboarc("pace_token", pace=True)
+        list(weiboarc.search_friendships())
+        list(weiboarc.search_friendships())
+
+        urls = [c[1][0] for c in mock_client.get.mock_calls]
+        self.assertEqual([RATE_LIMIT_URL, "statuses/friends_timeline", "statuses/friends_timeline"], urls)
+
+
+class TestRateLimitState(tests.TestCase):
+    @patch("weiboarc.time.sleep")
+    @patch("weiboarc.Client", autospec=True)
+    def test_wait_time_from_memory(self, mock_client_class, mock_sleep):
+        rate_limit = MagicMock()
+        rate_limit.status_code = 200
+        rate_limit.json.return_value = {"remaining_ip_hits": 1000, "remaining_user_hits": 2,
+                                        "reset_time_in_seconds": 1200}
+        rate_limit_error = APIError(10023, "User requests out of rate limit!", "/2/statuses/friends_timeline.json")
+        mock_client = mock_client_class.return_value
+        mock_client.get.side_effect = [rate_limit, _response([]), rate_limit_error, _response([])]
+
+        weiboarc1 = Weiboarc("state_token")
+        weiboarc2 = Weiboarc("state_token")
+        self.assertIs(weiboarc1.rate_limit_state, weiboarc2.rate_limit_state)
+        self.assertEqual(2, weiboarc1.rate_limit_status()["remaining_user_hits"])
+        list(weiboarc1.search_friendships())
+        self.assertEqual(1, weiboarc2.rate_limit_status()["remaining_user_hits"])
+
+        # the rate limit error is answered without calling the rate limit status again
+        list(weiboarc2.search_friendships())
+        self.assertEqual(1, [c[1][0] for c in mock_client.get.mock_calls].count(RATE_LIMIT_URL))
+        self.assertEqual(0, weiboarc1.rate_limit_status()["remaining_user_hits"])
+        self.assertGreaterEqual(mock_sleep.call_args[0][0], 1200)
+
+    @patch("weiboarc.time.sleep")
+    @patch("weiboarc.Client", autospec=True)
+    def test_wait_time_http_429(self, mock_client_class, mock_sleep):
+        rate_limit = MagicMock()
+        rate_limit.status_code = 200
+        rate_limit.json.return_value = {"remaining_ip_hits": 1000, "remaining_user_hits": 100,
+                                        "reset_time_in_seconds": 1200}
+        mock_client = mock_client_class.return_value
+        mock_client.get.side_effect = [rate_limit, MagicMock(status_code=429), rate_limit, _response([])]
+
+        weiboarc = Weiboarc("http_429_token")
+        self.assertEqual(100, weiboarc.rate_limit_status()["remaining_user_hits"])
+        self.assertEqual([], list(weiboarc.search_friendships()))
+
+        # not a quota, the rate limit status is asked again and hits are left
+        self.assertEqual(2, [c[1][0] for c in mock_client.get.mock_calls].count(RATE_LIMIT_URL))
+        mock_sleep.assert_called_once_with(60)
+        self.assertEqual(99, weiboarc.rate_limit_status()["remaining_user_hits"])
+
+    def test_stale(self):
+        clock = FakeClock()
+        state = RateLimitState(ttl=300, clock=clock)
+        self.assertTrue(state.stale())
+        state.update({"remaining_ip_hits": 1000, "remaining_user_hits": 150, "reset_time_in_seconds": 1200})
+        self.assertFalse(state.stale())
+        clock.now += 301
+        self.assertTrue(state.stale())
+
+
+class TestTokenRotation(tests.TestCase):
+    @patch("weiboarc.time.sleep")
+    @patch("weiboarc.Client", autospec=True)
+    def test_rotate(self, mock_client_class, mock_sleep):
+        rate_limit_error = APIError(10023, "User requests out of rate limit!", "/2/statuses/friends_timeline.json")
+        mock_client = mock_client_class.return_value
+        mock_client.get.side_effect = [rate_limit_error, _response([])]
+
+        weiboarc = Weiboarc(["rotate_token1", "rotate_token2"])
+        self.assertEqual([], list(weiboarc.search_friendships()))
+
+        self.assertEqual("rotate_token2", weiboarc.access_token)
+        mock_client.set_access_token.assert_called_once_with("rotate_token2")
+        mock_sleep.assert_not_called()
+
+    @patch("weiboarc.time.sleep")
+    @patch("weiboarc.Client", autospec=True)
+    def test_rotate_exhausted(self, mock_client_class, mock_sleep):
+        RateLimitState.for_token("exhausted_token2").update(
+            {"remaining_ip_hits": 1000, "remaining_user_hits": 0, "reset_time_in_seconds": 600})
+        rate_limit = MagicMock()
+        rate_limit.status_code = 200
+        rate_limit.json.return_value = {"remaining_ip_hits": 1000, "remaining_user_hits": 0,
+                                        "reset_time_in_seconds": 1200}
+        rate_limit_error = APIError(10024, "User requests for (statuses/friends_timeline) out of rate limit!",
+                                    "/2/statuses/friends_timeline.json")
+        mock_client = mock_client_class.return_value
+        mock_client.get.side_effect = [rate_limit_error, rate_limit, _response([])]
+
+        weiboarc = Weiboarc(["exhausted_token1", "exhausted_token2"])
+        self.assertEqual([], list(weiboarc.search_friendships()))
+
+        # no token left, sleeps until the reset
+        self.assertEqual("exhausted_token1", weiboarc.access_token)
+        mock_client.set_access_token.assert_not_called()
+        mock_sleep.assert_called_once_with(1210)
+
+    @patch("weiboarc.time.sleep")
+    @patch("weiboarc.Client", autospec=True)
+    def test_rotate_all_exhausted_never_refreshed(self, mock_client_class, mock_sleep):
+        rate_limit = MagicMock()
+        rate_limit.status_code = 200
+        rate_limit.json.return_value = {"remaining_ip_hits": 1000, "remaining_user_hits": 0,
+                                        "reset_time_in_seconds": 1200}
+        rate_limit_error = APIError(10023, "User requests out of rate limit!", "/2/statuses/friends_timeline.json")
+        mock_client = mock_client_class.return_value
+        mock_client.get.side_effect = [rate_limit_error, rate_limit_error, rate_limit, _response([])]
+
+        weiboarc = Weiboarc(["unrefreshed_token1", "unrefreshed_token2"])
+        self.assertEqual([], list(weiboarc.search_friendships()))
+
+        # rotates once, then sleeps until the reset rather than rotating back
+        self.assertEqual("unrefreshed_token2", weiboarc.access_token)
+        mock_client.set_access_token.assert_called_once_with("unrefreshed_token2")
+        self.assertEqual(4, mock_client.get.call_count)
+        mock_sleep.assert_called_once_with(1210)
+        self.assertEqual(0, RateLimitState.for_token("unrefreshed_token1").remaining_hits())
+
+
+class TestRetryPolicy(tests.TestCase):
+    @patch("weiboarc.Client", autospec=True)
+    def test_retry_server_error(self, mock_client_class):
+        clock = FakeClock()
+        mock_client = mock_client_class.return_value
+        mock_client.get.side_effect = [MagicMock(status_code=502), MagicMock(status_code=503),
+                                       _response([_status(110)]), _response([])]
+
+        weiboarc = Weiboarc("retry_token", retry_policy=RetryPolicy(base=2, clock=clock))
+        with patch("weiboarc.time.sleep", clock.sleep):
+            self.assertEqual([110], [status["id"] for status in weiboarc.search_friendships()])
+
+        # exponential backoff with jitter
+        self.assertEqual(2, len(clock.sleeps))
+        self.assertTrue(1 <= clock.sleeps[0] <= 2)
+        self.assertTrue(2 <= clock.sleeps[1] <= 4)
+
+    @patch("weiboarc.Client", autospec=True)
+    def test_request_budget(self, mock_client_class):
+        clock = FakeClock()
+        mock_client = mock_client_class.return_value
+        mock_client.get.return_value = MagicMock(status_code=500)
+
+        weiboarc = Weiboarc("budget_token", retry_policy=RetryPolicy(base=2, request_budget=60, clock=clock))
+        with patch("weiboarc.time.sleep", clock.sleep):
+            with self.assertRaises(RetryBudgetExceeded):
+                list(weiboarc.search_friendships())
+        self.assertLessEqual(clock.now, 60)
+
+    @patch("weiboarc.Client", autospec=True)
+    def test_connection_reset(self, mock_client_class):
+        mock_client = mock_client_class.return_value
+        mock_client.get.side_effect = [requests.exceptions.ConnectionError("Connection reset by peer"),
+                                       _response([])]
+
+        weiboarc = Weiboarc("reset_token", retry_policy=RetryPolicy(base=0))
+        self.assertEqual([], list(weiboarc.search_friendships()))
+        # the session is kept
+        mock_client_class.assert_called_once_with(access_token="reset_token", pool_maxsize=10)
+        self.assertEqual(2, mock_client.get.call_count)
+
+    def test_gives_up(self):
+        retry_policy = RetryPolicy()
+        self.assertFalse(retry_policy.gives_up("not_found", 10))
+        self.assertTrue(retry_policy.gives_up("not_found", 11))
+        self.assertFalse(retry_policy.gives_up("rate_limit", 1000))
+
+
+class TestClient(tests.TestCase):
+    def test_decode_once(self):
+        decoder = MagicMock(return_value={"statuses": []})
+        client = Client("token", decoder=decoder)
+        r = MagicMock(status_code=200, content=b'{"statuses": []}')
+        client.session = MagicMock()
+        client.session.get.return_value = r
+
+        resp = client.get("statuses/friends_timeline", count=100)
+        self.assertIsInstance(resp, WeiboResponse)
+        self.assertEqual({"statuses": []}, resp.json())
+        self.assertEqual({"statuses": []}, resp.json())
+        decoder.assert_called_once_with(b'{"statuses": []}')
+
+    def test_stream(self):
+        client = Client("token")
+        body = json.dumps({"statuses": [_status(weibo_id) for weibo_id in range(110, 90, -1)],
+                           "total_number": 20}).encode("utf-8")
+        r = MagicMock(status_code=200, raw=io.BytesIO(body))
+        client.session = MagicMock()
+        client.session.get.return_value = r
+
+        resp = client.get("statuses/friends_timeline", stream=True, count=100)
+        self.assertIsInstance(resp, WeiboStreamResponse)
+        statuses = resp.iter_statuses()
+        self.assertEqual(_status(110), next(statuses))
+        # the rest of the body is not parsed yet
+        self.assertLess(r.raw.tell(), len(body))
+        self.assertEqual(list(range(109, 90, -1)), [status["id"] for status in statuses])
+        client.session.get.assert_called_once_with("https://api.weibo.com/2/statuses/friends_timeline.json",
+                                                   params={"count": 100}, stream=True)
+
+    def test_stream_api_error(self):
+        body = b'{"error_code": 21327, "error": "expired_token", "request": "/2/statuses/friends_timeline.json"}'
+        resp = WeiboStreamResponse(MagicMock(status_code=200, raw=io.BytesIO(body)))
+        with self.assertRaises(APIError) as cm:
+            list(resp.iter_statuses())
+        self.assertEqual(21327, cm.exception.error_code)
+
+    @patch("weiboarc.time.sleep")
+    @patch("weiboarc.Client", autospec=True)
+    def test_stream_rate_limit(self, mock_client_class, mock_sleep):
+        def stream(body):
+            return WeiboStreamResponse(MagicMock(status_code=200, raw=io.BytesIO(json.dumps(body).encode("utf-8"))))
+
+        rate_limit = MagicMock()
+        rate_limit.status_code = 200
+        rate_limit.json.return_value = {"remaining_ip_hits": 1000, "remaining_user_hits": 0,
+                                        "reset_time_in_seconds": 1200}
+        # the error after a status already yielded
+        error = {"statuses": [_status(111)], "error_code": 10023, "error": "User requests out of rate limit!",
+                 "request": "/2/statuses/friends_timeline.json"}
+        mock_client = mock_client_class.return_value
+        mock_client.get.side_effect = [stream(error), rate_limit,
+                                       stream({"statuses": [_status(110), _status(109)]}), stream({"statuses": []})]
+
+        weiboarc = Weiboarc("stream_rate_limit_token", streaming=True)
+        self.assertEqual([111, 110, 109], [status["id"] for status in weiboarc.search_friendships()])
+
+        # retried as the rate limit errors of the non streamed responses
+        mock_sleep.assert_called_once_with(1210)
+        self.assertEqual(["statuses/friends_timeline", RATE_LIMIT_URL, "statuses/friends_timeline",
+                          "statuses/friends_timeline"], [c[1][0] for c in mock_client.get.mock_calls])
+        self.assertEqual("110", mock_client.get.mock_calls[2][2]["max_id"])
+
+    def test_pool(self):
+        client = Client("token", pool_connections=2, pool_maxsize=20)
+        adapter = client.session.get_adapter("https://api.weibo.com/2/statuses/friends_timeline.json")
+        self.assertIsInstance(adapter, KeepAliveAdapter)
+        self.assertEqual(20, adapter._pool_maxsize)
+        self.assertIn((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1), adapter.socket_options())
+
+    def test_api_error(self):
+        client = Client("token")
+        r = MagicMock(status_code=403, content=b'{"error_code": 10023, "error": "User requests out of rate limit!"}')
+        client.session = MagicMock()
+        client.session.get.return_value = r
+
+        with self.assertRaises(APIError) as cm:
+            client.get("statuses/friends_timeline")
+        self.assertEqual(10023, cm.exception.error_code)
@@ -2,10 +2,10 @@
 # -*- coding: utf-8 -*-
 
 from sfmutils.exporter import BaseExporter, BaseTable
-from weibo_warc_iter import WeiboWarcIter
+from weibo_warc_iter import WeiboWarcIter, parse_created_at
+from weibo_profile import profiled
 import logging
 import re
-from dateutil.parser import parse as date_parse
 
 log = logging.getLogger(__name__)
 
@@ -38,8 +38,9 @@ class WeiboStatusTable(BaseTable):
                 'retweeted_url1',
                 'retweeted_url2')
 
+    @profiled("export_row")
     def _row(self, item):
-        row = [date_parse(item["created_at"]),
+        row = [parse_created_at(item["created_at"]),
                item["mid"],
                item['user']['screen_name'],
                item['user']['followers_count'],
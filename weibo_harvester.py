@@ -3,9 +3,22 @@
 
 from __future__ import absolute_import
 import logging
-from sfmutils.harvester import BaseHarvester
-from weiboarc import Weiboarc
-from weibo_warc_iter import WeiboWarcIter
+import math
+import os
+import re
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from urllib.parse import urlparse, parse_qs
+from warcio.archiveiterator import ArchiveIterator
+from sfmutils.harvester import BaseHarvester, Msg
+from weiboarc import Weiboarc, RetryPolicy, RetryBudgetExceeded, MAX_SEARCH_RESULTS, MAX_WEIBO_PER_PAGE, \
+    MAX_FRIENDSHIPS_PER_PAGE, weibo_id_time
+from weibo_warc_iter import WeiboWarcIter, STATUS_URL_PREFIXES
+from weibo_seen_index import SeenIndex, SEEN_INDEX_FILENAME
+from weibo_metrics import metrics
+from weibo_profile import profiler, profiled, PROFILE_TIMERS
 
 log = logging.getLogger(__name__)
 
@@ -13,6 +26,26 @@ QUEUE = "weibo_harvester"
 SEARCH_ROUTING_KEY = "harvest.start.weibo.weibo_search"
 TIMELINE_ROUTING_KEY = "harvest.start.weibo.weibo_timeline"
 
+CODE_RETRY_BUDGET_EXCEEDED = "retry_budget_exceeded"
+CODE_SUGGESTED_INTERVAL = "suggested_interval"
+
+# Default number of seeds of a weibo_search harvest searched concurrently
+SEARCH_WORKERS = 4
+
+# Default days back of the oldest window of a weibo_timeline backfill
+BACKFILL_DAYS = 7
+
+# Margin over the weibos expected from the velocity of a topic when picking the search depth
+VELOCITY_MARGIN = 1.5
+
+# Bounds of the suggested interval until the next weibo_search harvest, in seconds
+MIN_SUGGESTED_INTERVAL = 300
+MAX_SUGGESTED_INTERVAL = 86400
+
+# The WARCs written by warcprox, <prefix>-<timestamp>-<serial>-<token>.warc.gz. The WARCs rotated
+# by the warcprox of a harvest share its prefix and token.
+WARC_NAME_RE = re.compile(r"^(?P<prefix>.+)-\d{17}-(?P<serial>\d{5})-(?P<token>.+?)\.warc(\.gz)?$")
+
 
 class WeiboHarvester(BaseHarvester):
     def __init__(self, working_path, mq_config=None, debug=False, debug_warcprox=False, tries=3):
@@ -20,22 +53,59 @@ class WeiboHarvester(BaseHarvester):
                                tries=tries)
         self.weiboarc = None
         self.incremental = False
+        # The ids of the statuses of each page harvested, by request url
+        self.page_summaries = None
+        self._counter_lock = threading.Lock()
+        # The state store is shared by the search workers
+        self._state_lock = threading.Lock()
+        # The scans of the WARCs parsed in the process pool, by path
+        self._warc_pool = None
+        self._warc_scans = {}
+        self._warc_scanned = set()
+        # The weibos seen by the WARCs processed for the collection set
+        self.seen_index = None
+        # The weibos seen by the previous harvests and by this one, never saved
+        self.harvest_seen_index = None
+        # The weibos per second of each topic searched, with the adaptive_depth option
+        self.query_velocities = {}
+        # The profile modes enabled by the profile option of the harvest
+        self.profile_modes = set()
+        # serves the metrics when WEIBO_METRICS_PORT is set
+        metrics.serve()
 
     def harvest_seeds(self):
-        self._create_weiboarc()
-
         # Get harvest extract options.
         self.incremental = self.message.get("options", {}).get("incremental", False)
+        self.page_summaries = {} if self.message.get("options", {}).get("harvest_summaries", False) else None
+        self.harvest_seen_index = SeenIndex(self._seen_index_filepath()) if self._dedupe() else None
+        # reloaded by the WARC processing, as another harvester may have saved it since
+        self.seen_index = None
+        self._reset_warc_pool()
+        self._reset_profile()
+        self._enable_profile()
+
+        self._create_weiboarc()
 
         harvest_type = self.message.get("type")
         log.debug("Harvest type is %s", harvest_type)
-        if harvest_type == "weibo_timeline":
-            self.friends_timeline()
-        elif harvest_type == "weibo_search":
-            self.search_topic()
-        else:
-            raise KeyError
+        try:
+            if harvest_type == "weibo_timeline":
+                self.friends_timeline()
+            elif harvest_type == "weibo_search":
+                self.search_topic()
+            else:
+                raise KeyError
+        except RetryBudgetExceeded as e:
+            # keep what has been harvested so far
+            if self.stop_harvest_seeds_event.is_set():
+                log.info("Harvest stopped while waiting to retry")
+            else:
+                log.warning("Stopping harvest: %s", e)
+                self.result.warnings.append(Msg(CODE_RETRY_BUDGET_EXCEEDED, str(e)))
+        finally:
+            metrics.dump()
 
+    @profiled("friends_timeline")
     def friends_timeline(self):
         """
         Weibo harvester is considered as a seedless harvester, the harvester message has no seeds info.
@@ -47,71 +117,514 @@ class WeiboHarvester(BaseHarvester):
         if len(collection_set_id):
             since_id = self.state_store.get_state(__name__, u"{}.since_id".format(
                 self.message["collection_set"]["id"])) if self.incremental else None
-            self._harvest_weibos(self.weiboarc.search_friendships(since_id=since_id))
+            options = self.message.get("options", {})
+            cursor_key = u"{}.cursor".format(collection_set_id)
+            kwargs = self._cursor_kwargs(cursor_key, since_id)
+            # an interrupted harvest resumes serially
+            if options.get("backfill_windows", 1) > 1 and "max_id" not in kwargs:
+                start_time = time.time() - options.get("backfill_days", BACKFILL_DAYS) * 86400
+                weibos = self.weiboarc.backfill_friendships(start_time, windows=options["backfill_windows"],
+                                                            since_id=since_id)
+            else:
+                weibos = self.weiboarc.search_friendships(**kwargs)
+            self._harvest_resumable(weibos, cursor_key, kwargs["since_id"], MAX_FRIENDSHIPS_PER_PAGE)
 
+    @profiled("search_topic")
     def search_topic(self):
-        assert len(self.message.get("seeds", [])) == 1
+        """
+        Search every seed of the harvest, concurrently when there are several, sharing
+        the rate limit budget of the weiboarc. Each seed keeps its own since_id.
+        """
+        self.query_velocities = {}
+        queries = self._search_queries()
+        if len(queries) == 1:
+            self._search_query(queries[0])
+        else:
+            workers = min(len(queries), self._search_workers())
+            log.debug("Searching %s topics with %s workers", len(queries), workers)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # consuming the results raises the errors of the searches
+                for _ in executor.map(self._search_query, queries):
+                    pass
+
+        if self.query_velocities:
+            self._suggest_interval()
+
+    def _search_query(self, query):
+        if self.stop_harvest_seeds_event.is_set():
+            return
         incremental = self.message.get("options", {}).get("incremental", False)
-        query = self.message["seeds"][0]["token"]
+        since_id = self._get_state(u"{}.since_id".format(query)) if incremental else None
+
+        cursor_key = u"{}.cursor".format(query)
+        kwargs = self._cursor_kwargs(cursor_key, since_id)
+        # the cursor of a harvest before the search resumed from page 1
+        kwargs.pop("page", None)
+        if not self.message.get("options", {}).get("adaptive_depth", False):
+            self._harvest_resumable(self.weiboarc.search_topic(query, **kwargs), cursor_key, kwargs["since_id"],
+                                    MAX_WEIBO_PER_PAGE)
+            return
+
+        velocity = self._get_state(u"{}.velocity".format(query))
+        # the serial search already stops at the page of the since_id
+        if velocity and since_id and "max_id" not in kwargs and self.message.get("options", {}).get("concurrent_search"):
+            kwargs["max_pages"] = self._search_pages(velocity)
+            log.debug(u"Searching %s pages for %s", kwargs["max_pages"], query)
+        observed = {"count": 0, "oldest_id": None}
+        self._harvest_resumable(self.weiboarc.search_topic(query, **kwargs), cursor_key, kwargs["since_id"],
+                                MAX_WEIBO_PER_PAGE, observed)
+        self._update_velocity(query, velocity, kwargs["since_id"], observed)
+
+    @staticmethod
+    def _observe(weibos, observed):
+        for weibo in weibos:
+            observed["count"] += 1
+            observed["oldest_id"] = weibo["id"]
+            yield weibo
+
+    @staticmethod
+    def _search_pages(velocity):
+        """
+        The pages expected to hold the weibos of the topic since its last harvest.
+        """
+        expected = velocity["rate"] * (time.time() - velocity["time"]) * VELOCITY_MARGIN
+        return min(max(int(math.ceil(expected / MAX_WEIBO_PER_PAGE)), 1), MAX_SEARCH_RESULTS // MAX_WEIBO_PER_PAGE)
+
+    def _update_velocity(self, query, velocity, since_id, observed):
+        """
+        Average the weibos per second of the topic with the ones observed by this search, over
+        the time since the since_id, or since the oldest weibo for a first search. The times
+        come from the timestamp bits of the weibo ids.
+        """
+        now = time.time()
+        if since_id:
+            start = weibo_id_time(since_id)
+        elif observed["oldest_id"]:
+            start = weibo_id_time(observed["oldest_id"])
+        else:
+            return
+        rate = observed["count"] / max(now - start, 60)
+        if velocity:
+            rate = (velocity["rate"] + rate) / 2
+        self._set_state(u"{}.velocity".format(query), {"time": now, "rate": rate})
+        with self._counter_lock:
+            self.query_velocities[query] = rate
+
+    def _suggest_interval(self):
+        """
+        Report the interval until the next harvest in which the fastest topic fills the
+        search results.
+        """
+        rate = max(self.query_velocities.values())
+        interval = MAX_SUGGESTED_INTERVAL
+        if rate:
+            interval = min(max(MAX_SEARCH_RESULTS / (rate * VELOCITY_MARGIN), MIN_SUGGESTED_INTERVAL),
+                           MAX_SUGGESTED_INTERVAL)
+        log.info("Suggested interval until the next harvest is %d seconds", interval)
+        self.result.infos.append(Msg(CODE_SUGGESTED_INTERVAL,
+                                     "Suggested interval until the next harvest is {} seconds".format(int(interval))))
+
+    def _search_queries(self):
+        return [seed["token"] for seed in self.message.get("seeds", [])]
+
+    def _search_workers(self):
+        return self.message.get("options", {}).get("search_workers", SEARCH_WORKERS)
+
+    def _cursor_kwargs(self, cursor_key, since_id):
+        """
+        The paging keyword arguments from the since_id, resuming from the cursor left by
+        an interrupted harvest. With the checkpoint_pages option, the cursor is
+        checkpointed every checkpoint_pages pages.
+        """
+        kwargs = {"since_id": since_id}
+        checkpoint_pages = self.message.get("options", {}).get("checkpoint_pages")
+        if checkpoint_pages:
+            pages = [0]
+
+            def on_cursor(cursor):
+                pages[0] += 1
+                if not pages[0] % checkpoint_pages:
+                    self._set_state(cursor_key, cursor)
+
+            kwargs["on_cursor"] = on_cursor
+        cursor = self._get_state(cursor_key)
+        if cursor:
+            # the since_id of the interrupted harvest, newer weibos are left to the next one
+            log.info("Resuming from %s", cursor)
+            kwargs.update(cursor)
+        return kwargs
+
+    def _harvest_resumable(self, weibos, cursor_key, since_id, page_size, observed=None):
+        """
+        Harvest the weibos of a search, newest first. When the time budget stops it, a
+        cursor is left for the next incremental harvest to resume from, since the since_id
+        still moves up to the newest weibo harvested.
+        """
+        observed = observed if observed is not None else {"count": 0, "oldest_id": None}
+        try:
+            self._harvest_weibos(self._observe(weibos, observed), page_size)
+        except RetryBudgetExceeded:
+            if self.incremental:
+                if observed["oldest_id"] is not None:
+                    cursor = {"since_id": since_id, "max_id": int(observed["oldest_id"]) - 1}
+                else:
+                    cursor = self._get_state(cursor_key) or {"since_id": since_id}
+                log.info("Leaving %s to resume from", cursor)
+                self._set_state(cursor_key, cursor)
+            raise
+        self._clear_cursor(cursor_key)
 
-        since_id = self.state_store.get_state(__name__, u"{}.since_id".format(query)) if incremental else None
+    def _clear_cursor(self, cursor_key):
+        if self.message.get("options", {}).get("checkpoint_pages") or self._get_state(cursor_key):
+            self._set_state(cursor_key, None)
 
-        self._harvest_weibos(self.weiboarc.search_topic(query, since_id=since_id))
+    def _get_state(self, key):
+        """
+        Get the state, serialized with the other search workers since the state store
+        is not thread safe.
+        """
+        with self._state_lock:
+            return self.state_store.get_state(__name__, key)
+
+    def _set_state(self, key, value):
+        with self._state_lock:
+            self.state_store.set_state(__name__, key, value)
 
     def _create_weiboarc(self):
-        self.weiboarc = Weiboarc(self.message["credentials"]["access_token"])
+        credentials = self.message["credentials"]
+        # additional access tokens to rotate through when one reaches its rate limit
+        access_tokens = [credentials["access_token"]] + [token for token in credentials.get("access_tokens", [])
+                                                         if token != credentials["access_token"]]
+        self.weiboarc = Weiboarc(access_tokens if len(access_tokens) > 1 else access_tokens[0],
+                                 **self._weiboarc_options())
 
-    def _harvest_weibos(self, weibos):
+    def _weiboarc_options(self):
+        """
+        The Weiboarc keyword arguments enabled by the harvest options.
+        """
+        options = self.message.get("options", {})
+        kwargs = {}
+        if options.get("concurrent_search", False):
+            kwargs["concurrent_search"] = True
+        if self.message.get("type") == "weibo_search" and len(self._search_queries()) > 1:
+            # enough connections for the concurrent searches
+            pages = MAX_SEARCH_RESULTS // MAX_WEIBO_PER_PAGE if options.get("concurrent_search", False) else 1
+            kwargs["pool_maxsize"] = max(min(len(self._search_queries()), self._search_workers()) * pages, 10)
+        if self.message.get("type") == "weibo_timeline" and options.get("backfill_windows", 1) > 10:
+            kwargs["pool_maxsize"] = options["backfill_windows"]
+        if options.get("pace_requests", False):
+            kwargs["pace"] = True
+        if options.get("streaming", False):
+            kwargs["streaming"] = True
+        if self.page_summaries is not None:
+            kwargs["on_page"] = self._summarize_page
+        if options.get("time_budget") or options.get("request_time_budget"):
+            deadline = time.monotonic() + options["time_budget"] if options.get("time_budget") else None
+            kwargs["retry_policy"] = RetryPolicy(request_budget=options.get("request_time_budget"),
+                                                 deadline=deadline,
+                                                 stop_event=self.stop_harvest_seeds_event)
+        return kwargs
+
+    def _harvest_weibos(self, weibos, page_size):
+        """
+        Count the weibos, only the ones not seen before when deduping. With the
+        dedupe_stop_paging option, the paging stops after a page worth of weibos in
+        a row were all seen.
+        """
+        stop_paging = self.message.get("options", {}).get("dedupe_stop_paging", False)
+        started = time.monotonic()
+        seen_count = 0
+        harvested = 0
         for count, weibo in enumerate(weibos):
             if not count % 100:
                 log.debug("Harvested %s weibos", count)
             if "text" in weibo:
-                self.result.harvest_counter["weibos"] += 1
+                if self.harvest_seen_index is None or self.harvest_seen_index.add(weibo["id"]):
+                    with self._counter_lock:
+                        self.result.harvest_counter["weibos"] += 1
+                    harvested += 1
+                    seen_count = 0
+                else:
+                    seen_count += 1
+                if stop_paging and seen_count >= page_size:
+                    log.info("Stopping paging after %s weibos seen before", seen_count)
+                    break
+        harvest_type = self.message.get("type")
+        metrics.inc("weibo_harvested_statuses_total", harvested, type=harvest_type)
+        metrics.set("weibo_harvested_statuses_per_second", harvested / max(time.monotonic() - started, 0.001),
+                    type=harvest_type)
+
+    def _dedupe(self):
+        return self.message.get("options", {}).get("dedupe", False)
+
+    def _seen_index_filepath(self):
+        # next to the state of the collection set
+        return os.path.join(self.message["path"], SEEN_INDEX_FILENAME)
+
+    def _load_seen_index(self):
+        if not self._dedupe():
+            self.seen_index = None
+        elif self.seen_index is None or self.seen_index.filepath != self._seen_index_filepath():
+            self.seen_index = SeenIndex(self._seen_index_filepath())
+
+    def _new_weibo(self, weibo_id):
+        """
+        Whether the weibo was not seen by a previous WARC, adding it to the seen index.
+        """
+        return self.seen_index is None or self.seen_index.add(weibo_id)
+
+    def _summarize_page(self, url, statuses):
+        """
+        Keep the ids of the statuses of a page, so that process_warc does not have
+        to parse the WARC again.
+        """
+        statuses = [status for status in statuses if "id" in status]
+        ids = array("q", (status["id"] for status in statuses))
+        texts = bytes(bytearray("text" in status for status in statuses))
+        with self._counter_lock:
+            self.page_summaries[url] = (ids, texts)
 
     def process_warc(self, warc_filepath):
         harvest_type = self.message.get("type")
         log.debug("Harvest type is %s", harvest_type)
+        self._load_seen_index()
+        self._enable_profile()
+        started = time.monotonic()
+        counted = self.result.stats_summary().get("weibos", 0)
         if harvest_type == "weibo_search":
             self.process_search_warc(warc_filepath)
         elif harvest_type == "weibo_timeline":
             self.process_timeline_warc(warc_filepath)
         else:
             raise KeyError
+        if self.seen_index is not None:
+            self.seen_index.save()
+
+        seconds = time.monotonic() - started
+        counted = self.result.stats_summary().get("weibos", 0) - counted
+        metrics.observe("weibo_process_warc_seconds", seconds, type=harvest_type)
+        metrics.inc("weibo_processed_statuses_total", counted, type=harvest_type)
+        metrics.set("weibo_processed_statuses_per_second", counted / max(seconds, 0.001), type=harvest_type)
+        metrics.dump()
+        # the profiles of the harvest so far, next to its WARCs
+        profiler.write(os.path.dirname(os.path.abspath(warc_filepath)), self.message["id"])
+
+    def _enable_profile(self):
+        """
+        Enable the profile modes of the profile option, e.g. "timers,cprofile", in
+        addition to the ones of WEIBO_PROFILE.
+        """
+        modes = self.message.get("options", {}).get("profile")
+        if modes:
+            modes = set(modes.split(",") if isinstance(modes, str) else modes)
+            added = (modes | {PROFILE_TIMERS}) - profiler.modes
+            profiler.enable(modes)
+            self.profile_modes |= added
+
+    def _reset_profile(self):
+        """
+        Scope the profile to the harvest, disabling the modes enabled by the profile
+        option of the previous harvest and forgetting what it profiled.
+        """
+        if self.profile_modes:
+            profiler.disable(self.profile_modes)
+            self.profile_modes = set()
+        profiler.reset()
 
+    @profiled("process_warc")
     def process_search_warc(self, warc_filepath):
+        """
+        Count the weibos of the WARC, only the ones newer than the since_id of their
+        query when incremental. The since_id watermarks are tracked in memory and
+        written to the state store once, at the end of the WARC.
+        """
+        # since_id of each query when the WARC processing started
         since_weibo_ids = {}
-        query = self.message["seeds"][0]["token"]
-        key = u"{}.since_id".format(query)
-        for count, status in enumerate(WeiboWarcIter(warc_filepath)):
-            weibo = status.item
+        max_weibo_ids = {}
+        queries = {}
+        for count, (url, weibo_id, _) in enumerate(self._warc_weibos(warc_filepath)):
             if not count % 25:
                 log.debug("Processing %s weibos", count)
-            if "id" in weibo:
-                weibo_id = weibo.get("id")
-                if not self.incremental:
-                    self.result.increment_stats("weibos")
+            if weibo_id is not None:
+                if url not in queries:
+                    queries[url] = self._url_query(url)
+                query = queries[url]
+                new = self._new_weibo(weibo_id)
+                if not self.incremental or query is None:
+                    if new:
+                        self.result.increment_stats("weibos")
                 else:
-                    since_id = self.state_store.get_state(__name__, key) or 0
-                    if key not in since_weibo_ids:
-                        since_weibo_ids[key] = since_id
-                    if weibo_id > since_id:
-                        # Update state
-                        self.state_store.set_state(__name__, key, weibo_id)
-                    if weibo_id > since_weibo_ids[key]:
+                    if query not in since_weibo_ids:
+                        since_weibo_ids[query] = self.state_store.get_state(__name__,
+                                                                            u"{}.since_id".format(query)) or 0
+                        max_weibo_ids[query] = since_weibo_ids[query]
+                    if new and weibo_id > since_weibo_ids[query]:
                         self.result.increment_stats("weibos")
+                    if weibo_id > max_weibo_ids[query]:
+                        max_weibo_ids[query] = weibo_id
 
+        # Update state
+        for query, max_weibo_id in max_weibo_ids.items():
+            if max_weibo_id > since_weibo_ids[query]:
+                self.state_store.set_state(__name__, u"{}.since_id".format(query), max_weibo_id)
+
+    def _url_query(self, url):
+        """
+        The seed query of a search/topics request url, None if it is not one of the seeds.
+        """
+        queries = self._search_queries()
+        if url:
+            q = parse_qs(urlparse(url).query).get("q")
+            if q and q[0] in queries:
+                return q[0]
+        return queries[0] if len(queries) == 1 else None
+
+    @profiled("process_warc")
     def process_timeline_warc(self, warc_filepath):
-        for count, status in enumerate(WeiboWarcIter(warc_filepath)):
-            weibo = status.item
+        """
+        Count the weibos of the WARC. When incremental, the max id is kept while
+        iterating and committed to the state store once, at the end of the WARC.
+        """
+        max_weibo_id = 0
+        for count, (_, weibo_id, has_text) in enumerate(self._warc_weibos(warc_filepath)):
             if not count % 100:
                 log.debug("Processing %s weibos", count)
-            if "text" in weibo:
-                self.result.increment_stats("weibos")
-                if self.incremental:
-                    # Update state
-                    key = u"{}.since_id".format(self.message["collection_set"]["id"])
-                    self.state_store.set_state(__name__, key,
-                                               max(self.state_store.get_state(__name__, key) or 0, weibo.get("id")))
+            if has_text:
+                if self._new_weibo(weibo_id):
+                    self.result.increment_stats("weibos")
+                if self.incremental and weibo_id > max_weibo_id:
+                    max_weibo_id = weibo_id
+
+        if max_weibo_id:
+            # Update state
+            key = u"{}.since_id".format(self.message["collection_set"]["id"])
+            if max_weibo_id > (self.state_store.get_state(__name__, key) or 0):
+                self.state_store.set_state(__name__, key, max_weibo_id)
+
+    def _warc_weibos(self, warc_filepath):
+        """
+        The request url, id and whether it has text of each status of the WARC. They
+        come from the page summaries of the harvest when every API response of the
+        WARC has one, otherwise from parsing the WARC.
+        """
+        urls = self._warc_summary_urls(warc_filepath)
+        if urls is not None:
+            log.debug("Using the summaries of %s harvested pages for %s", len(urls), warc_filepath)
+            for url in urls:
+                ids, texts = self.page_summaries[url]
+                for weibo_id, has_text in zip(ids, texts):
+                    yield url, weibo_id, bool(has_text)
+            return
+
+        pages = self._scanned_pages(warc_filepath)
+        if pages is not None:
+            for url, ids, texts in pages:
+                for weibo_id, has_text in zip(ids, texts):
+                    yield url, weibo_id, bool(has_text)
+            return
+
+        for status in WeiboWarcIter(warc_filepath, lazy=True):
+            weibo = status.item
+            yield status.url, weibo.get("id"), "text" in weibo
+
+    def _scanned_pages(self, warc_filepath):
+        """
+        The pages of the WARC parsed in the process pool, or None if the warc_workers
+        option is not set. The WARC also submits the WARCs rotated after it by the same
+        warcprox, so that they are parsed while the WARCs before them are counted. The
+        counting stays in the order process_warc is called.
+        """
+        workers = self.message.get("options", {}).get("warc_workers")
+        if not workers or workers < 2:
+            return None
+
+        if warc_filepath not in self._warc_scans:
+            if self._warc_pool is None:
+                self._warc_pool = ProcessPoolExecutor(max_workers=workers)
+            for filepath in [warc_filepath] + self._sibling_warcs(warc_filepath):
+                if filepath not in self._warc_scans and filepath not in self._warc_scanned:
+                    log.debug("Submitting %s to the WARC process pool", filepath)
+                    self._warc_scans[filepath] = self._warc_pool.submit(scan_warc, filepath)
+
+        future = self._warc_scans.pop(warc_filepath)
+        self._warc_scanned.add(warc_filepath)
+        if not self._warc_scans:
+            self._reset_warc_pool()
+        return future.result()
+
+    def _reset_warc_pool(self):
+        """
+        Shut down the WARC process pool, dropping the scans not processed, e.g. of the
+        WARCs of an interrupted harvest.
+        """
+        if self._warc_pool is not None:
+            for future in self._warc_scans.values():
+                future.cancel()
+            self._warc_pool.shutdown(wait=False)
+            self._warc_pool = None
+        self._warc_scans = {}
+        self._warc_scanned = set()
+
+    @staticmethod
+    def _sibling_warcs(warc_filepath):
+        """
+        The WARCs of the directory rotated after the WARC by the same warcprox, in serial
+        order. The directory may hold the WARCs of other harvests, so none are returned
+        for a WARC not named by warcprox.
+        """
+        match = WARC_NAME_RE.match(os.path.basename(warc_filepath))
+        if not match:
+            return []
+        dir_path = os.path.dirname(warc_filepath)
+        siblings = []
+        for filename in os.listdir(dir_path or "."):
+            sibling = WARC_NAME_RE.match(filename)
+            if sibling and sibling.group("prefix", "token") == match.group("prefix", "token") \
+                    and sibling.group("serial") > match.group("serial"):
+                siblings.append((sibling.group("serial"), os.path.join(dir_path, filename)))
+        return [filepath for _, filepath in sorted(siblings)]
+
+    def _warc_summary_urls(self, warc_filepath):
+        """
+        The urls of the successful responses of the status endpoints in the WARC, or
+        None if one of them has no page summary. Only the record headers are read.
+        """
+        if not self.page_summaries:
+            return None
+        urls = []
+        with open(warc_filepath, "rb") as f:
+            for record in ArchiveIterator(f):
+                if record.rec_type != "response":
+                    continue
+                url = record.rec_headers.get_header("WARC-Target-URI")
+                # no statuses in the other endpoints, e.g. account/rate_limit_status
+                if not url.startswith(STATUS_URL_PREFIXES):
+                    continue
+                # the errors have no statuses
+                if record.http_headers is None or record.http_headers.get_statuscode() != "200":
+                    continue
+                if url not in self.page_summaries:
+                    log.debug("No summary of %s, parsing %s", url, warc_filepath)
+                    return None
+                urls.append(url)
+        return urls
+
+
+def scan_warc(warc_filepath):
+    """
+    Parse a WARC into the pages of its statuses, as (url, ids, text flags) like the page
+    summaries. It is a module function so that it can run in a process pool.
+    """
+    pages = []
+    for status in WeiboWarcIter(warc_filepath, lazy=True):
+        weibo = status.item
+        if "id" not in weibo:
+            continue
+        if not pages or pages[-1][0] != status.url:
+            pages.append((status.url, array("q"), bytearray()))
+        pages[-1][1].append(weibo["id"])
+        pages[-1][2].append("text" in weibo)
+    return [(url, ids, bytes(texts)) for url, ids, texts in pages]
 
 
 if __name__ == "__main__":
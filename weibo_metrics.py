@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A registry of the metrics of the harvester and of the Weibo API client,
+rendered in the Prometheus text format. The metrics are served on
+/metrics when WEIBO_METRICS_PORT is set, and dumped to WEIBO_METRICS_FILE
+at the end of the harvest and WARC processing stages when it is set.
+"""
+
+from __future__ import absolute_import
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+log = logging.getLogger(__name__)
+
+METRICS_PORT_ENV = "WEIBO_METRICS_PORT"
+METRICS_FILE_ENV = "WEIBO_METRICS_FILE"
+
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metrics(object):
+    """
+    Counters, gauges and histograms by name and labels. Updates take a lock,
+    so the hot loops should add up their counts before reporting them.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counters = {}
+        self._gauges = {}
+        # bucket counts, then sum and count
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """
+        Add to a counter.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """
+        Set a gauge.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        """
+        Add an observation to a histogram.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observe the seconds spent in the block in a histogram.
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def value(self, name, **labels):
+        """
+        The value of a counter or gauge, or the count of a histogram.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            if key in self._histograms:
+                return self._histograms[key][-1]
+            return self._counters.get(key, self._gauges.get(key, 0))
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def render(self):
+        """
+        The metrics in the Prometheus text format.
+        """
+        lines = []
+        with self._lock:
+            for metric_type, metrics in (("counter", self._counters), ("gauge", self._gauges)):
+                for name in sorted({name for name, _ in metrics}):
+                    lines.append("# TYPE {} {}".format(name, metric_type))
+                    for key in sorted(key for key in metrics if key[0] == name):
+                        lines.append("{}{} {}".format(name, _labels(key[1]), _number(metrics[key])))
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append("# TYPE {} histogram".format(name))
+                for key in sorted(key for key in self._histograms if key[0] == name):
+                    histogram = self._histograms[key]
+                    for bound, count in zip(self.buckets + ("+Inf",), histogram[:-2] + histogram[-1:]):
+                        lines.append("{}_bucket{} {}".format(name, _labels(key[1] + (("le", str(bound)),)), count))
+                    lines.append("{}_sum{} {}".format(name, _labels(key[1]), _number(histogram[-2])))
+                    lines.append("{}_count{} {}".format(name, _labels(key[1]), histogram[-1]))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, filepath=None):
+        """
+        Write the metrics to the file, WEIBO_METRICS_FILE by default. Nothing is
+        written when neither is set.
+        """
+        filepath = filepath or os.environ.get(METRICS_FILE_ENV)
+        if not filepath:
+            return
+        tmp_filepath = filepath + ".tmp"
+        with open(tmp_filepath, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_filepath, filepath)
+
+    def serve(self, port=None):
+        """
+        Serve the metrics on /metrics from a daemon thread, on WEIBO_METRICS_PORT by
+        default. Nothing is served when neither is set, or when already serving.
+        :return: the HTTPServer
+        """
+        if port is None and os.environ.get(METRICS_PORT_ENV):
+            port = int(os.environ[METRICS_PORT_ENV])
+        if port is None or self._server is not None:
+            return self._server
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format, *args)
+
+        self._server = HTTPServer(("", port), MetricsHandler)
+        thread = threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True)
+        thread.start()
+        log.info("Serving metrics on port %s", self._server.server_address[1])
+        return self._server
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, value.replace("\\", "\\\\").replace('"', '\\"')
+                                           .replace("\n", "\\n")) for key, value in labels) + "}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# The registry reported into by weiboarc and the harvester
+metrics = Metrics()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Opt-in profiling of the harvest and export stages. WEIBO_PROFILE lists the
+modes, comma separated:
+
+* timers: wall and CPU time of each stage
+* cprofile: a cProfile of the outermost stages
+* tracemalloc: the top allocations since the first stage
+
+The harvester writes the profiles next to the WARCs it processes. The
+profiles are also written to WEIBO_PROFILE_DIR at exit when it is set.
+"""
+
+from __future__ import absolute_import
+import atexit
+import cProfile
+import functools
+import json
+import logging
+import os
+import re
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+PROFILE_ENV = "WEIBO_PROFILE"
+PROFILE_DIR_ENV = "WEIBO_PROFILE_DIR"
+
+PROFILE_TIMERS = "timers"
+PROFILE_CPROFILE = "cprofile"
+PROFILE_TRACEMALLOC = "tracemalloc"
+
+# Allocation sites listed in the tracemalloc report
+TRACEMALLOC_TOP = 50
+
+
+class Profiler(object):
+    """
+    Accumulates the calls, wall and CPU seconds of each stage. The CPU time is
+    the one of the thread running the stage.
+    """
+
+    def __init__(self, modes=()):
+        self.modes = set()
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._cprofile = None
+        self._cprofile_owner = None
+        self.enable(modes)
+
+    @classmethod
+    def from_env(cls):
+        modes = [mode.strip() for mode in os.environ.get(PROFILE_ENV, "").split(",") if mode.strip()]
+        profiler = cls(modes)
+        if profiler.enabled and os.environ.get(PROFILE_DIR_ENV):
+            atexit.register(profiler.write, os.environ[PROFILE_DIR_ENV])
+        return profiler
+
+    @property
+    def enabled(self):
+        return bool(self.modes)
+
+    def enable(self, modes):
+        """
+        Add profiling modes, timers are always recorded once enabled.
+        """
+        modes = set(modes)
+        if not modes:
+            return
+        unknown = modes - {PROFILE_TIMERS, PROFILE_CPROFILE, PROFILE_TRACEMALLOC}
+        if unknown:
+            raise ValueError("Unknown profile modes: {}".format(", ".join(sorted(unknown))))
+        self.modes |= modes | {PROFILE_TIMERS}
+        if PROFILE_CPROFILE in self.modes and self._cprofile is None:
+            self._cprofile = cProfile.Profile()
+        if PROFILE_TRACEMALLOC in self.modes and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        log.info("Profiling %s", ", ".join(sorted(self.modes)))
+
+    def disable(self, modes):
+        """
+        Remove profiling modes, stopping the cProfile and tracemalloc once they are removed.
+        """
+        self.modes -= set(modes)
+        if PROFILE_CPROFILE not in self.modes:
+            self._cprofile = None
+        if PROFILE_TRACEMALLOC not in self.modes and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        log.info("Profiling %s", ", ".join(sorted(self.modes)) or "disabled")
+
+    def reset(self):
+        """
+        Forget the stages, cProfile and allocations profiled so far.
+        """
+        with self._lock:
+            self.stages = {}
+            if self._cprofile is not None and self._cprofile_owner is None:
+                self._cprofile = cProfile.Profile()
+        if tracemalloc.is_tracing():
+            tracemalloc.clear_traces()
+
+    def _add(self, name, wall, cpu, calls=1):
+        with self._lock:
+            stage = self.stages.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0})
+            stage["calls"] += calls
+            stage["wall"] += wall
+            stage["cpu"] += cpu
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the block as the stage. The cProfile only profiles the outermost
+        stage of the first thread entering one.
+        """
+        if not self.enabled:
+            yield
+            return
+        depth = getattr(self._local, "depth", 0)
+        profile = self._cprofile if depth == 0 and self._acquire_cprofile() else None
+        self._local.depth = depth + 1
+        wall, cpu = time.perf_counter(), time.thread_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                self._cprofile_owner = None
+            self._local.depth = depth
+            self._add(name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+    def _acquire_cprofile(self):
+        with self._lock:
+            if self._cprofile is None or self._cprofile_owner is not None:
+                return False
+            self._cprofile_owner = threading.current_thread()
+            return True
+
+    def iterate(self, name, items):
+        """
+        Yield the items, timing only the time spent producing them as the stage.
+        """
+        calls, wall, cpu = 0, 0.0, 0.0
+        items = iter(items)
+        try:
+            while True:
+                started_wall, started_cpu = time.perf_counter(), time.thread_time()
+                try:
+                    item = next(items)
+                finally:
+                    wall += time.perf_counter() - started_wall
+                    cpu += time.thread_time() - started_cpu
+                    calls += 1
+                yield item
+        except StopIteration:
+            return
+        finally:
+            self._add(name, wall, cpu, calls)
+
+    def write(self, dir_path, prefix="weibo"):
+        """
+        Write the profiles to the directory, overwriting the ones written before:
+        <prefix>.profile.json for the timers, <prefix>.prof for the cProfile, to
+        be read with pstats, and <prefix>.tracemalloc.txt.
+        :return: the paths written
+        """
+        if not self.enabled:
+            return []
+        prefix = re.sub(r"[^\w.-]", "_", prefix)
+        filepaths = []
+        filepath = os.path.join(dir_path, "{}.profile.json".format(prefix))
+        with self._lock:
+            stages = json.dumps(self.stages, indent=2, sort_keys=True)
+        with open(filepath, "w") as f:
+            f.write(stages)
+        filepaths.append(filepath)
+
+        if self._cprofile is not None:
+            filepath = os.path.join(dir_path, "{}.prof".format(prefix))
+            self._cprofile.dump_stats(filepath)
+            filepaths.append(filepath)
+
+        if PROFILE_TRACEMALLOC in self.modes and tracemalloc.is_tracing():
+            filepath = os.path.join(dir_path, "{}.tracemalloc.txt".format(prefix))
+            with open(filepath, "w") as f:
+                for stat in tracemalloc.take_snapshot().statistics("lineno")[:TRACEMALLOC_TOP]:
+                    f.write("{}\n".format(stat))
+            filepaths.append(filepath)
+        log.debug("Wrote profiles %s", filepaths)
+        return filepaths
+
+
+def profiled(name):
+    """
+    Decorate a function to time its calls as the stage when profiling.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            with profiler.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# The profiler of the process, enabled by WEIBO_PROFILE
+profiler = Profiler.from_env()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+import logging
+import os
+import threading
+from array import array
+from bisect import bisect_left
+
+log = logging.getLogger(__name__)
+
+# File of the index, next to the state of the collection set
+SEEN_INDEX_FILENAME = "weibo_seen_ids.bin"
+
+
+class SeenIndex(object):
+    """
+    The ids of the weibos seen by the previous harvests, kept as a sorted array
+    of int64, 8 bytes per weibo. The ids added since the last save are kept in
+    a set and merged into the array on save.
+    """
+
+    def __init__(self, filepath=None):
+        """
+        :param filepath: the file the index is loaded from and saved to, None to keep
+        it in memory only
+        """
+        self.filepath = filepath
+        self.ids = array("q")
+        self.added = set()
+        self._lock = threading.Lock()
+        if filepath and os.path.exists(filepath):
+            with open(filepath, "rb") as f:
+                self.ids.frombytes(f.read())
+            log.debug("Loaded %s seen weibo ids from %s", len(self.ids), filepath)
+
+    def __len__(self):
+        return len(self.ids) + len(self.added)
+
+    def __contains__(self, weibo_id):
+        weibo_id = int(weibo_id)
+        pos = bisect_left(self.ids, weibo_id)
+        return (pos < len(self.ids) and self.ids[pos] == weibo_id) or weibo_id in self.added
+
+    def add(self, weibo_id):
+        """
+        Add the id, returning True if it was not seen before.
+        """
+        with self._lock:
+            if weibo_id in self:
+                return False
+            self.added.add(int(weibo_id))
+            return True
+
+    def save(self):
+        """
+        Merge the added ids into the array and write it to the file.
+        """
+        with self._lock:
+            if self.added:
+                self.ids = array("q", sorted(self.ids + array("q", self.added)))
+                self.added = set()
+            if self.filepath:
+                tmp_filepath = self.filepath + ".tmp"
+                with open(tmp_filepath, "wb") as f:
+                    self.ids.tofile(f)
+                os.replace(tmp_filepath, self.filepath)
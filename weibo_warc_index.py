@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+"""
+Build the sidecar indexes of Weibo WARCs, so that WeiboWarcIter seeks to the
+API response records in the date range and of the users it is asked for.
+"""
+
+from __future__ import absolute_import
+import argparse
+import logging
+from weibo_warc_iter import build_index, index_filepath
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser("weibo_warc_index")
+    parser.add_argument("--debug", action="store_true", help="Print debug logging")
+    parser.add_argument("warc_filepaths", nargs="+", help="The WARCs to index")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format="%(asctime)s %(levelname)s %(message)s"
+    )
+
+    for warc_filepath in args.warc_filepaths:
+        index = build_index(warc_filepath)
+        log.info("Wrote %s with %s records", index_filepath(warc_filepath), len(index["records"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,359 @@
 #!/usr/bin/env python3
 
 from __future__ import absolute_import
-from sfmutils.warc_iter import BaseWarcIter
+import heapq
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import queue
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from warcio.archiveiterator import ArchiveIterator
+from sfmutils.warc_iter import BaseWarcIter, IterItem
 from dateutil.parser import parse as date_parse
+from weibo_profile import profiler
+
+try:
+    # on demand parsing of the statuses for the lazy iteration
+    import simdjson
+    JSON_OBJECT_TYPES = (dict, simdjson.Object)
+except ImportError:
+    simdjson = None
+    JSON_OBJECT_TYPES = (dict,)
+
+log = logging.getLogger(__name__)
+
+API_URL_PREFIX = "https://api.weibo.com/2"
+
+# The endpoints responding with statuses
+STATUS_URL_PREFIXES = (API_URL_PREFIX + "/search/topics", API_URL_PREFIX + "/statuses/friends_timeline")
+
+# The sidecar index of a WARC is the WARC path with this suffix
+INDEX_SUFFIX = ".idx.json"
+INDEX_VERSION = 1
+
+# The default number of processes decoding the WARCs, and order of their items
+WARC_WORKERS_ENV = "WEIBO_WARC_WORKERS"
+WARC_ORDER_ENV = "WEIBO_WARC_ORDER"
+
+# The items as they are decoded, or merged by created_at
+ORDER_ARRIVAL = "arrival"
+ORDER_CREATED_AT = "created_at"
+
+# Items sent back by the processes at once, and chunks buffered
+QUEUE_CHUNK_SIZE = 100
+QUEUE_CHUNKS = 64
+
+MONTHS = {month: number for number, month in enumerate(
+    ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"), 1)}
+
+
+@lru_cache(maxsize=4096)
+def parse_created_at(created_at):
+    """
+    Parse the created_at of a status, always like "Fri Jan 06 14:27:41 +0800 2017".
+    The statuses of a page share a few seconds, so the parsed dates are cached.
+    Other shapes are parsed by dateutil.
+    """
+    try:
+        _, month, day, clock, offset, year = created_at.split(" ")
+        hour, minute, second = clock.split(":")
+        return datetime(int(year), MONTHS[month], int(day), int(hour), int(minute), int(second),
+                        tzinfo=_timezone(offset))
+    except (ValueError, KeyError):
+        return date_parse(created_at)
+
+
+def _timestamp(date):
+    # only timezone aware dates compare with the dates of the statuses
+    if date is None or date.tzinfo is None:
+        return None
+    return date.timestamp()
+
+
+@lru_cache(maxsize=None)
+def _timezone(offset):
+    if len(offset) != 5 or offset[0] not in "+-":
+        raise ValueError(offset)
+    minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+    return timezone(timedelta(minutes=-minutes if offset[0] == "-" else minutes))
+
+
+def index_filepath(warc_filepath):
+    return warc_filepath + INDEX_SUFFIX
+
+
+def build_index(warc_filepath):
+    """
+    Write the sidecar index of the WARC, with the offset of each API response record
+    and the range of ids and unix times and the user ids of its statuses.
+    :return: the index
+    """
+    records = []
+    with open(warc_filepath, "rb") as f:
+        archive_iterator = ArchiveIterator(f)
+        for record in archive_iterator:
+            if record.rec_type != "response":
+                continue
+            url = record.rec_headers.get_header("WARC-Target-URI")
+            if not url.startswith(API_URL_PREFIX):
+                continue
+            content = record.content_stream().read()
+            # the offset is known once the record is read to its end
+            entry = {"offset": archive_iterator.get_record_offset(), "url": url}
+            try:
+                json_obj = json.loads(content.decode("utf-8"))
+            except ValueError:
+                json_obj = None
+            statuses = json_obj.get("statuses", []) if isinstance(json_obj, dict) else []
+            if statuses:
+                ids = [int(status["mid"]) for status in statuses]
+                times = [parse_created_at(status["created_at"]).timestamp() for status in statuses]
+                entry.update({
+                    "min_id": min(ids),
+                    "max_id": max(ids),
+                    "min_time": min(times),
+                    "max_time": max(times),
+                    "user_ids": sorted({status.get("user", {}).get("idstr") for status in statuses} - {None})
+                })
+            records.append(entry)
+
+    index = {"version": INDEX_VERSION, "warc_size": os.path.getsize(warc_filepath), "records": records}
+    tmp_filepath = index_filepath(warc_filepath) + ".tmp"
+    with open(tmp_filepath, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_filepath, index_filepath(warc_filepath))
+    log.debug("Indexed %s records of %s", len(records), warc_filepath)
+    return index
+
+
+def load_index(warc_filepath):
+    """
+    The sidecar index of the WARC, None if there is none or it is not the one of the
+    WARC as it is now.
+    """
+    try:
+        with open(index_filepath(warc_filepath)) as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if index.get("version") != INDEX_VERSION or index.get("warc_size") != os.path.getsize(warc_filepath):
+        log.warning("Ignoring the stale index of %s", warc_filepath)
+        return None
+    return index
 
 
 class WeiboWarcIter(BaseWarcIter):
-    def __init__(self, file_paths, limit_user_ids=None):
+    def __init__(self, file_paths, limit_user_ids=None, workers=None, order=None, lazy=False):
+        """
+        :param workers: the number of processes decoding the WARCs in parallel,
+        WEIBO_WARC_WORKERS or 1 by default
+        :param order: with several workers, "arrival" (default) for the items as they
+        are decoded, or "created_at" to merge the WARCs by created_at
+        :param lazy: yield the statuses as read-only simdjson views, whose fields are
+        only decoded when accessed, when pysimdjson is installed. For the passes that
+        only read a few fields of each status. The items of the parallel iteration
+        are always dicts, since the views cannot be sent between processes.
+        """
         BaseWarcIter.__init__(self, file_paths)
-        self.limit_user_ids = limit_user_ids
+        self.limit_user_ids = frozenset(limit_user_ids) if limit_user_ids else None
+        self.workers = workers or int(os.environ.get(WARC_WORKERS_ENV, 1))
+        self.order = order or os.environ.get(WARC_ORDER_ENV, ORDER_ARRIVAL)
+        if self.order not in (ORDER_ARRIVAL, ORDER_CREATED_AT):
+            raise ValueError("Unknown order {}".format(self.order))
+        self.lazy = lazy and simdjson is not None
+
+    def iter(self, limit_item_types=None, dedupe=False, item_date_start=None, item_date_end=None):
+        kwargs = dict(limit_item_types=limit_item_types, item_date_start=item_date_start,
+                      item_date_end=item_date_end)
+        if self.workers > 1 and len(self.filepaths) > 1:
+            items = self._iter_parallel(dedupe, kwargs)
+        else:
+            items = self._iter_files(dedupe=dedupe, **kwargs)
+        if profiler.enabled:
+            return profiler.iterate("warc_iter", items)
+        return items
+
+    def _iter_files(self, limit_item_types=None, dedupe=False, item_date_start=None, item_date_end=None):
+        indexes = [load_index(filepath) for filepath in self.filepaths]
+        if any(indexes) or item_date_start or item_date_end or self.limit_user_ids or self.lazy:
+            return self._iter_selected(indexes, limit_item_types, dedupe, item_date_start, item_date_end)
+        return BaseWarcIter.iter(self, limit_item_types=limit_item_types, dedupe=dedupe,
+                                 item_date_start=item_date_start, item_date_end=item_date_end)
+
+    def _iter_parallel(self, dedupe, kwargs):
+        """
+        Decode the WARCs in a process pool. The items are deduped here, across the WARCs.
+        """
+        log.debug("Iterating %s WARCs with %s processes by %s", len(self.filepaths), self.workers, self.order)
+        workers = min(self.workers, len(self.filepaths))
+        if self.order == ORDER_CREATED_AT:
+            items = self._iter_merged(workers, kwargs)
+        else:
+            items = self._iter_arrival(workers, kwargs)
+        seen_ids = set()
+        for item in items:
+            if dedupe:
+                if item.id in seen_ids:
+                    continue
+                seen_ids.add(item.id)
+            yield item
+
+    def _iter_arrival(self, workers, kwargs):
+        """
+        The items of all the WARCs as they are decoded, sent back in chunks through a
+        bounded queue so that the processes do not run ahead of the consumer.
+        """
+        with multiprocessing.Manager() as manager, ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = manager.Queue(maxsize=QUEUE_CHUNKS)
+            stop = manager.Event()
+            futures = [executor.submit(_queue_items, filepath, self.limit_user_ids, kwargs, chunks, stop)
+                       for filepath in self.filepaths]
+            done = 0
+            try:
+                while done < len(futures):
+                    chunk = chunks.get()
+                    if chunk is None:
+                        done += 1
+                    elif isinstance(chunk, Exception):
+                        raise chunk
+                    else:
+                        for item in chunk:
+                            yield item
+            finally:
+                if done < len(futures):
+                    # unblock the processes still sending items
+                    stop.set()
+                    for future in futures:
+                        future.cancel()
+                    while not all(future.done() for future in futures):
+                        try:
+                            chunks.get(timeout=0.1)
+                        except queue.Empty:
+                            pass
+
+    def _iter_merged(self, workers, kwargs):
+        """
+        The items of all the WARCs merged by created_at. The processes sort the items of
+        each WARC into a temporary file, read back a chunk at a time, so that only a chunk
+        of each WARC is held here. The first item is known once all the WARCs are sorted.
+        """
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_spill_sorted_items, filepath, self.limit_user_ids, kwargs)
+                       for filepath in self.filepaths]
+            try:
+                spills = [_read_spill(future.result()) for future in futures]
+                for item in heapq.merge(*spills, key=_item_date):
+                    yield item
+            finally:
+                for future in futures:
+                    if future.cancel():
+                        continue
+                    try:
+                        spill_filepath = future.result()
+                    except Exception:
+                        continue
+                    if os.path.exists(spill_filepath):
+                        os.remove(spill_filepath)
+
+    def _iter_selected(self, indexes, limit_item_types, dedupe, item_date_start, item_date_end):
+        """
+        Iterate like BaseWarcIter, rejecting the records that cannot hold items in the
+        date range and of the users before their statuses are iterated. The records of
+        the indexed WARCs are rejected from their index, without being read.
+        """
+        seen_ids = set()
+        for filepath, index in zip(self.filepaths, indexes):
+            for url, json_obj in self._records(filepath, index, item_date_start, item_date_end):
+                if index is None and not self._select_page(json_obj, item_date_start, item_date_end):
+                    continue
+                for item_type, item_id, item_date, item in self._item_iter(url, json_obj):
+                    if limit_item_types and item_type not in limit_item_types:
+                        continue
+                    if item_date_start and item_date < item_date_start:
+                        continue
+                    if item_date_end and item_date > item_date_end:
+                        continue
+                    if not self._select_item(item):
+                        continue
+                    if dedupe:
+                        if item_id in seen_ids:
+                            continue
+                        seen_ids.add(item_id)
+                    yield IterItem(item_type, item_id, item_date, url, item)
+
+    def _records(self, filepath, index, item_date_start, item_date_end):
+        """
+        The url and json of the API response records of the WARC, seeking to the ones
+        selected by the index when there is one.
+        """
+        with open(filepath, "rb") as f:
+            if index is None:
+                records = (record for record in ArchiveIterator(f) if record.rec_type == "response"
+                           and self._select_record(record.rec_headers.get_header("WARC-Target-URI")))
+            else:
+                records = self._seek_records(f, index, item_date_start, item_date_end)
+            for record in records:
+                try:
+                    json_obj = self._loads(record.content_stream().read())
+                except ValueError:
+                    continue
+                yield record.rec_headers.get_header("WARC-Target-URI"), json_obj
+
+    def _loads(self, content):
+        if self.lazy:
+            # a parser per record, since the views of a document hold on to its parser
+            return simdjson.Parser().parse(content)
+        return json.loads(content.decode("utf-8"))
+
+    def _seek_records(self, f, index, item_date_start, item_date_end):
+        start_time = _timestamp(item_date_start)
+        end_time = _timestamp(item_date_end)
+        for entry in index["records"]:
+            # pages without statuses, e.g. errors
+            if "min_time" not in entry:
+                continue
+            if start_time is not None and entry["max_time"] < start_time:
+                continue
+            if end_time is not None and entry["min_time"] > end_time:
+                continue
+            if self.limit_user_ids and self.limit_user_ids.isdisjoint(entry["user_ids"]):
+                continue
+            f.seek(entry["offset"])
+            yield next(iter(ArchiveIterator(f)))
+
+    def _select_page(self, json_obj, item_date_start, item_date_end):
+        """
+        Whether the page may hold items in the date range and of the users. The statuses
+        of a page are in time order, so its first and last statuses bound its dates.
+        """
+        statuses = json_obj.get("statuses") if isinstance(json_obj, JSON_OBJECT_TYPES) else None
+        # no items in the errors and empty pages
+        if not statuses:
+            return False
+        if item_date_start or item_date_end:
+            first, last = parse_created_at(statuses[0]["created_at"]), parse_created_at(statuses[-1]["created_at"])
+            if item_date_start and max(first, last) < item_date_start:
+                return False
+            if item_date_end and min(first, last) > item_date_end:
+                return False
+        if self.limit_user_ids:
+            return any(status.get("user", {}).get("idstr") in self.limit_user_ids for status in statuses)
+        return True
 
     def _select_record(self, url):
-        return url.startswith("https://api.weibo.com/2")
+        return url.startswith(API_URL_PREFIX)
 
     def _item_iter(self, url, json_obj):
-        if isinstance(json_obj, dict) and ('error' in json_obj):
+        # no statuses in the errors and the other endpoints, e.g. account/rate_limit_status
+        if not isinstance(json_obj, JSON_OBJECT_TYPES) or 'error' in json_obj:
             return
-        for status in json_obj["statuses"]:
-            yield "weibo_status", status["mid"], date_parse(status["created_at"]), status
+        for status in json_obj.get("statuses", ()):
+            yield "weibo_status", status["mid"], parse_created_at(status["created_at"]), status
 
     @staticmethod
     def item_types():
@@ -29,5 +365,57 @@ class WeiboWarcIter(BaseWarcIter):
         return False
 
 
+def _item_date(item):
+    return item.date
+
+
+def _queue_items(filepath, limit_user_ids, kwargs, chunks, stop):
+    """
+    Send the items of a WARC to the queue in chunks, then None once done.
+    """
+    try:
+        chunk = []
+        for item in WeiboWarcIter(filepath, limit_user_ids, workers=1)._iter_files(**kwargs):
+            chunk.append(item)
+            if len(chunk) == QUEUE_CHUNK_SIZE:
+                if stop.is_set():
+                    return
+                chunks.put(chunk)
+                chunk = []
+        if chunk:
+            chunks.put(chunk)
+    except Exception as e:
+        chunks.put(e)
+    finally:
+        chunks.put(None)
+
+
+def _spill_sorted_items(filepath, limit_user_ids, kwargs):
+    """
+    Write the items of a WARC sorted by created_at to a temporary file, in pickled chunks.
+    :return: the path of the file
+    """
+    items = sorted(WeiboWarcIter(filepath, limit_user_ids, workers=1)._iter_files(**kwargs), key=_item_date)
+    with tempfile.NamedTemporaryFile(prefix="weibo_warc_", suffix=".pickle", delete=False) as f:
+        try:
+            for start in range(0, len(items), QUEUE_CHUNK_SIZE):
+                pickle.dump(items[start:start + QUEUE_CHUNK_SIZE], f, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            os.remove(f.name)
+            raise
+    return f.name
+
+
+def _read_spill(spill_filepath):
+    with open(spill_filepath, "rb") as f:
+        while True:
+            try:
+                chunk = pickle.load(f)
+            except EOFError:
+                return
+            for item in chunk:
+                yield item
+
+
 if __name__ == "__main__":
     WeiboWarcIter.main(WeiboWarcIter)
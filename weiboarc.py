@@ -3,24 +3,84 @@
 
 from __future__ import absolute_import
 import os
+import queue
 import sys
 import logging
 import time
 import json
+import math
+import random
+import socket
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
 import argparse
+from collections import Counter
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 import configparser
+from weibo_metrics import metrics
+
+try:
+    # use a faster json decoder for the large timeline pages when installed
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        json_loads = ujson.loads
+    except ImportError:
+        json_loads = json.loads
+
+try:
+    # incremental parsing of the streamed timeline pages
+    import ijson
+    from ijson.common import ObjectBuilder
+except ImportError:
+    ijson = None
+
+try:
+    import OpenSSL
+    # connection reset errors from pyOpenSSL, see https://github.com/edsu/twarc/issues/72
+    CONNECTION_ERRORS = (requests.exceptions.ConnectionError, OpenSSL.SSL.SysCallError)
+except ImportError:
+    CONNECTION_ERRORS = (requests.exceptions.ConnectionError,)
 
 log = logging.getLogger(__name__)
 
 # Max weibos in per page
 MAX_WEIBO_PER_PAGE = 50
 
+# The search API only provides the latest 200 results
+MAX_SEARCH_RESULTS = 200
+
+# Max weibos in per page of the friends timeline
+MAX_FRIENDSHIPS_PER_PAGE = 100
+
+# Pages of statuses buffered for each window of a backfill
+BACKFILL_QUEUE_PAGES = 4
+
+# The rate limit status API is not rate limited itself
+RATE_LIMIT_URL = "account/rate_limit_status"
+
+# Seconds before the locally accounted rate limit is refreshed from the API
+RATE_LIMIT_TTL = 300
+
 # Error code for weibo api
 # 10022   IP requests out of rate limit
 # 10023   User requests out of rate limit
 # 10024   User requests for (%s) out of rate limit
+RATE_LIMIT_ERROR_CODES = (10022, 10023, 10024)
+
+# The kinds of retried request errors
+RETRY_RATE_LIMIT = "rate_limit"
+RETRY_NOT_FOUND = "not_found"
+RETRY_SERVER_ERROR = "server_error"
+RETRY_CONNECTION = "connection"
+
+# The 41 high bits of a weibo id are the seconds since this unix time
+WEIBO_ID_EPOCH = 515483463
 
 def main():
     """
@@ -39,7 +99,7 @@ def main():
     parser.add_argument("--log", dest="log",
                         default="weiboarc.log", help="log file")
     parser.add_argument("--access_token",
-                        default=None, help="Weibo API access_token")
+                        default=None, help="Weibo API access_token, or comma separated access_tokens")
     parser.add_argument('-c', '--config',
                         default=default_config_filename(),
                         help="Config file containing Weibo keys and secrets")
@@ -47,6 +107,12 @@ def main():
                         help="Name of a profile in your configuration file")
     parser.add_argument('-w', '--warnings', action='store_true',
                         help="Include warning messages in output")
+    parser.add_argument('--concurrent', action='store_true',
+                        help="Fetch all the pages of a topic search in parallel")
+    parser.add_argument('--pace', action='store_true',
+                        help="Spread the remaining rate limit over the rate limit window")
+    parser.add_argument('--stream', action='store_true',
+                        help="Parse the timeline statuses as they are received")
 
     args = parser.parse_args()
 
@@ -68,7 +134,9 @@ def main():
 
             save_keys(args.profile, access_token)
 
-    weiboarc = Weiboarc(access_token=access_token)
+    access_tokens = access_token.split(',')
+    weiboarc = Weiboarc(access_token=access_tokens if len(access_tokens) > 1 else access_token,
+                        concurrent_search=args.concurrent, pace=args.pace, streaming=args.stream)
     weibos = []
     if args.search:
         weibos = weiboarc.search_topic(
@@ -130,59 +198,60 @@ def default_config_filename():
     return os.path.join(home, ".weiboarc")
 
 
-def catch_conn_reset(f):
+def classify_error(status_code=None, error=None):
     """
-    A decorator to handle connection reset errors even ones from pyOpenSSL
-    until https://github.com/edsu/twarc/issues/72 is resolved
+    The kind of retry for a failed request, or None if it should not be retried.
+    :param status_code: the http status code of the response
+    :param error: the APIError or the connection error raised by the request
     """
-    try:
-        import OpenSSL
-        ConnectionError = OpenSSL.SSL.SysCallError
-    except:
-        ConnectionError = requests.exceptions.ConnectionError
-    def new_f(self, *args, **kwargs):
-        try:
-            return f(self, *args, **kwargs)
-        except ConnectionError:
-            self._connect()
-            return f(self, *args, **kwargs)
-    return new_f
+    if isinstance(error, APIError):
+        return RETRY_RATE_LIMIT if error.error_code in RATE_LIMIT_ERROR_CODES else None
+    if error is not None:
+        return RETRY_CONNECTION
+    if status_code == 429:
+        return RETRY_RATE_LIMIT
+    if status_code == 404:
+        return RETRY_NOT_FOUND
+    if status_code >= 500:
+        return RETRY_SERVER_ERROR
+    return None
+
+
+def wait_seconds(rl):
+    """
+    The seconds to sleep for a rate limit error, given the response of
+    account/rate_limit_status or None if it is not available.
+    """
+    if rl:
+        if rl['remaining_ip_hits'] > 1 and rl['remaining_user_hits'] > 1:
+            return 60
+        return rl['reset_time_in_seconds'] + 10
+
+    return seconds_to_reset() + 60
 
-def status_error(f):
+
+def seconds_to_reset():
     """
-    A decorator to handle http response error from the Weibo API.
-    refer: https://github.com/edsu/twarc/blob/master/twarc.py
+    The seconds until the rate limits are reset, at the top of the hour.
     """
+    now = datetime.now()
+    reset = now + timedelta(seconds=3600 - now.minute * 60 - now.second)
+    reset_ts = time.mktime(datetime.timetuple(reset))
+    return reset_ts - time.time()
+
+
+def weibo_id_time(weibo_id):
+    """
+    The unix time a weibo was posted, from the timestamp bits of its id.
+    """
+    return (int(weibo_id) >> 22) + WEIBO_ID_EPOCH
 
-    def new_f(*args, **kwargs):
-        errors = 0
-        while True:
-            resp = f(*args, **kwargs)
-            if resp.status_code == 200:
-                errors = 0
-                return resp
-            elif resp.status_code == 404:
-                errors += 1
-                logging.warning("404:Not found url! Sleep 1s to try again...")
-                if errors > 10:
-                    logging.warning("Too many errors 404, stop!")
-                    resp.raise_for_status()
-                logging.warning("%s from request URL, sleeping 1s", resp.status_code)
-                time.sleep(1)
-
-            # deal with the response error
-            elif resp.status_code >= 500:
-                errors += 1
-                if errors > 30:
-                    logging.warning("Too many errors from Weibo REST API Server, stop!")
-                    resp.raise_for_status()
-                seconds = 60 * errors
-                logging.warning("%s from Weibo REST API Server, sleeping %d", resp.status_code, seconds)
-                time.sleep(seconds)
-            else:
-                resp.raise_for_status()
 
-    return new_f
+def time_weibo_id(timestamp):
+    """
+    The smallest weibo id posted at the unix time.
+    """
+    return max(int(timestamp) - WEIBO_ID_EPOCH, 0) << 22
 
 
 class Weiboarc(object):
@@ -191,39 +260,84 @@ class Weiboarc(object):
     get data from the friendships API.
     """
 
-    def __init__(self, access_token):
+    def __init__(self, access_token, concurrent_search=False, pace=False, retry_policy=None, pool_maxsize=10,
+                 streaming=False, on_page=None):
         """
         Instantiate a Weiboarc instance. Make sure your  variables
         are set.
+        :param access_token: the Weibo API access_token, or a list of access_tokens to
+        rotate through when one reaches its user rate limit
+        :param concurrent_search: fetch all the pages of a topic search in parallel
+        :param pace: pace the requests with a token bucket seeded from the rate limit status
+        :param retry_policy: the RetryPolicy scheduling the retries of the failed requests
+        :param pool_maxsize: the max number of connections kept alive to the API
+        :param streaming: yield the timeline statuses as they are parsed from the response
+        stream instead of after the whole page, requires ijson
+        :param on_page: callable receiving the request url and all the statuses of each page
+        fetched, before the since_id and max_id filter
         """
 
-        self.access_token = access_token
+        if isinstance(access_token, (list, tuple)):
+            self.access_tokens = list(access_token)
+        else:
+            self.access_tokens = [access_token]
+        self.access_token = self.access_tokens[0]
+        self.concurrent_search = concurrent_search
+        self.limiter = TokenBucket(self.rate_limit_status) if pace else None
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.pool_maxsize = pool_maxsize
+        if streaming and ijson is None:
+            raise ImportError("ijson is required for streaming")
+        self.streaming = streaming
+        self.on_page = on_page
+        self._rotate_lock = threading.Lock()
+        # the access tokens rate limited since the last successful request
+        self._rate_limited_tokens = set()
         self._connect()
 
-    def search_topic(self, q, since_id=None, max_id=None):
+    @property
+    def rate_limit_state(self):
+        return RateLimitState.for_token(self.access_token)
+
+    def search_topic(self, q, since_id=None, max_id=None, on_cursor=None, max_pages=None):
         """
         Return the latest 200 weibos related to a query topic
         :param q: keyword for topic to search
         :param since_id: it will return the weibo with id larger than the id
-        :param max_id: it will return the weibo with id smaller than the id
+        :param max_id: it will return the weibo with id smaller than the id. The pages
+        of weibos all newer than it are skipped, to resume an interrupted search
+        :param on_cursor: callable receiving the since_id and max_id to resume from,
+        once the statuses of a page have been consumed. The results are positional, so a
+        resumed search pages from the first page again rather than from a page number
+        :param max_pages: the last page to request, all the 4 pages by default. With
+        concurrent_search, the pages after it are requested too when its statuses are all
+        newer than the since_id, so that none are missed
         """
         log.info(u"starting search for topic:%s.", q)
+        if self.concurrent_search:
+            for status in self._search_topic_concurrent(q, since_id=since_id, max_id=max_id, max_pages=max_pages):
+                yield status
+            return
+
         search_url = "search/topics"
         # for MAX_WEIBO_PER_PAGE, if set==50, sometime it returns 48 or 49 in one page.
         params = {
             'count': MAX_WEIBO_PER_PAGE,
             'q': q
         }
-        start_page = 1
+        page = 1
         while True:
-            params['page'] = start_page
+            params['page'] = page
 
             # if access more than 200, avoid ["error_code": "21411", error": "only provide 200 results"]
-            if start_page * MAX_WEIBO_PER_PAGE > 200:
+            if page * MAX_WEIBO_PER_PAGE > 200:
+                break
+            if max_pages and page > max_pages:
                 break
 
             resp = self.get(search_url, **params)
-            statuses = resp.json()['statuses'] if 'statuses' in resp.json() else []
+            statuses = resp.json().get('statuses', [])
+            self._page_fetched(resp, statuses)
 
             if len(statuses) == 0:
                 logging.info("reach the end of calling for weibos statues.")
@@ -235,6 +349,11 @@ class Weiboarc(object):
             if since_id:
                 end_pos = self._upper_bound(statuses, since_id)
 
+            # newer weibos pushed the max_id of a resumed search to a later page
+            if start_pos == len(statuses):
+                page += 1
+                continue
+
             # checks the result after filtering
             if len(statuses[start_pos:end_pos]) == 0:
                 logging.info("no new weibos matching since_id %s and max_id %s", since_id, max_id)
@@ -246,75 +365,303 @@ class Weiboarc(object):
             max_id = status[u'id'] - 1
 
             # if the page has apply filter and found the post id, it should be the last page
-            if 0 < (end_pos - start_pos) < len(statuses):
+            if end_pos < len(statuses):
                 logging.info("reach the last page for since_id %s and max_id %s", since_id, max_id)
                 break
 
             # go to the next page
-            start_page += 1
+            page += 1
+            if on_cursor:
+                on_cursor({"since_id": since_id, "max_id": max_id})
 
-    def search_friendships(self, max_id=None, since_id=None):
+    def _search_topic_concurrent(self, q, since_id=None, max_id=None, max_pages=None):
+        """
+        Since the search API caps the results at 200, the whole page set is known
+        up front. Request all the pages in parallel over the client session, then
+        merge them in id order before applying the since_id and max_id filter.
+        """
+        search_url = "search/topics"
+        pages = range(1, min(MAX_SEARCH_RESULTS // MAX_WEIBO_PER_PAGE, max_pages or MAX_SEARCH_RESULTS) + 1)
+
+        def fetch_page(page):
+            resp = self.get(search_url, count=MAX_WEIBO_PER_PAGE, q=q, page=page)
+            statuses = resp.json().get('statuses', [])
+            self._page_fetched(resp, statuses)
+            return statuses
+
+        with ThreadPoolExecutor(max_workers=len(pages)) as executor:
+            pages_statuses = list(executor.map(fetch_page, pages))
+            # cut off by max_pages before reaching the since_id
+            if since_id and pages_statuses[-1] and pages[-1] < MAX_SEARCH_RESULTS // MAX_WEIBO_PER_PAGE \
+                    and min(status[u'id'] for statuses in pages_statuses for status in statuses) > since_id:
+                log.info(u"since_id %s not reached in %s pages for topic:%s", since_id, len(pages), q)
+                pages = range(pages[-1] + 1, MAX_SEARCH_RESULTS // MAX_WEIBO_PER_PAGE + 1)
+                pages_statuses.extend(executor.map(fetch_page, pages))
+
+        # the pages may overlap when new weibos are posted during the search
+        statuses = {}
+        for page_statuses in pages_statuses:
+            for status in page_statuses:
+                statuses[status[u'id']] = status
+        statuses = sorted(statuses.values(), key=lambda s: s[u'id'], reverse=True)
+
+        start_pos, end_pos = 0, len(statuses)
+        if max_id:
+            start_pos = self._lower_bound(statuses, max_id)
+        if since_id:
+            end_pos = self._upper_bound(statuses, since_id)
+
+        if len(statuses[start_pos:end_pos]) == 0:
+            logging.info("no new weibos matching since_id %s and max_id %s", since_id, max_id)
+
+        for status in statuses[start_pos:end_pos]:
+            yield status
+
+    def search_friendships(self, max_id=None, since_id=None, on_cursor=None):
         """
         Return all the results with optional max_id, since_id and get
         back an iterator for decoded weibo post.
         :param since_id: it will return the weibo with id larger than the id
         :param max_id: it will return the weibo with id smaller than the id
+        :param on_cursor: callable receiving the since_id and max_id to resume from,
+        once the statuses of a page have been consumed
         """
         log.info("starting search for max_id:%s, since_id:%s.", max_id, since_id)
         friendships_url = "statuses/friends_timeline"
         params = {
-            'count': 100,
+            'count': MAX_FRIENDSHIPS_PER_PAGE,
             'page': 1
         }
 
+        # the clock time of the first try of a page failing with a rate limit error in its stream
+        started = None
         while True:
             if since_id:
                 params['since_id'] = since_id
             if max_id:
                 params['max_id'] = max_id
 
-            resp = self.get(friendships_url, **params)
-            statuses = resp.json()['statuses'] if 'statuses' in resp.json() else []
-            if len(statuses) == 0:
+            access_token = self.access_token
+            resp = self.get(friendships_url, stream=self.streaming, **params)
+            count = 0
+            page = [] if self.on_page else None
+            try:
+                for status in resp.iter_statuses():
+                    """
+                    the application level need deal the retweeted text.
+                    if u'retweeted_status' in status and status[u'retweeted_status'] is not None:
+                        yield status[u'retweeted_status']
+                    """
+                    count += 1
+                    if page is not None:
+                        page.append(status)
+                    yield status
+            except APIError as e:
+                # the error of a 200 response is only found once its stream is parsed, after get
+                if classify_error(error=e) != RETRY_RATE_LIMIT:
+                    raise
+                log.error("caught APIError error %s", e)
+                metrics.inc("weibo_api_retries_total", kind=RETRY_RATE_LIMIT, code=e.error_code)
+                if started is None:
+                    started = self.retry_policy.clock()
+                self._rate_limited(access_token, e.error_code, started)
+                if count:
+                    # resume after the statuses already yielded
+                    max_id = str(int(status[u'mid']) - 1)
+                continue
+            started = None
+            self._page_fetched(resp, page)
+
+            if count == 0:
                 log.info("no new weibo post matching %s", params)
                 break
 
-            for status in statuses:
-                """
-                the application level need deal the retweeted text.
-                if u'retweeted_status' in status and status[u'retweeted_status'] is not None:
-                    yield status[u'retweeted_status']
-                """
+            max_id = str(int(status[u'mid']) - 1)
+            if on_cursor:
+                on_cursor({"since_id": since_id, "max_id": max_id})
+
+    def backfill_friendships(self, start_time, windows=4, since_id=None, end_time=None):
+        """
+        Return the same statuses as search_friendships, splitting the ids into
+        windows by time that are paged concurrently. The windows are
+        (since_id, b1], (b1, b2], ... (bn, None] for boundaries evenly spread in
+        time between start_time (or the time of since_id if later) and end_time,
+        so each status belongs to a single window.
+        :param start_time: unix time of the oldest boundary, the oldest window
+        still reaches back to since_id
+        :param windows: the number of windows
+        :param since_id: it will return the weibo with id larger than the id
+        :param end_time: unix time of the newest boundary, now by default
+
+        The windows send their statuses back a page at a time through bounded queues, so
+        the windows after the one being yielded only run a few pages ahead. Closing the
+        generator stops them.
+        """
+        end_time = end_time or time.time()
+        if since_id:
+            start_time = max(start_time, weibo_id_time(since_id))
+        if windows < 2 or start_time >= end_time:
+            for status in self.search_friendships(since_id=since_id):
                 yield status
+            return
 
-            max_id = str(int(status[u'mid']) - 1)
+        step = (end_time - start_time) / windows
+        boundaries = [time_weibo_id(start_time + step * i) for i in range(1, windows)]
+        # the newest window first, as search_friendships
+        ranges = list(reversed(list(zip([since_id] + boundaries, boundaries + [None]))))
+        log.info("starting backfill for since_id:%s in %s windows.", since_id, len(ranges))
 
-    @status_error
-    @catch_conn_reset
-    def get(self, *args, **kwargs):
+        stop = threading.Event()
+        windows_pages = [queue.Queue(maxsize=BACKFILL_QUEUE_PAGES) for _ in ranges]
+        executor = ThreadPoolExecutor(max_workers=len(ranges))
+        try:
+            for (window_since_id, window_max_id), pages in zip(ranges, windows_pages):
+                executor.submit(self._page_window, window_since_id, window_max_id, pages, stop)
+            seen_ids = set()
+            for pages in windows_pages:
+                while True:
+                    page = pages.get()
+                    if page is None:
+                        break
+                    if isinstance(page, Exception):
+                        raise page
+                    for status in page:
+                        if status[u'id'] not in seen_ids:
+                            seen_ids.add(status[u'id'])
+                            yield status
+        finally:
+            # the windows still paging stop at their next page
+            stop.set()
+            executor.shutdown(wait=False)
+
+    def _page_window(self, since_id, max_id, pages, stop):
+        """
+        Put the statuses of a backfill window into the queue a page at a time, then
+        None once done, or the error raised. Gives up once stop is set.
+        """
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        statuses = self.search_friendships(max_id=max_id, since_id=since_id)
         try:
-            r = self.client.get(*args, **kwargs)
-            # if rate limit reach
-            if r.status_code == 429:
-                seconds = self.wait_time()
-                logging.warning("Rate limit 429 from Weibo API, Sleep %d to try...", seconds)
-                time.sleep(seconds)
-                r = self.get(*args, **kwargs)
-            return r
-        except APIError as e:
-            # if rate limit reach
-            log.error("caught APIError error %s", e)
-            if e.error_code in [10022, 10023, 10024]:
-                seconds = self.wait_time()
-                logging.warning("Rate limit %d from Weibo API, Sleep %d to try...", e.error_code, seconds)
-                time.sleep(seconds)
-                return self.get(*args, **kwargs)
+            page = []
+            for status in statuses:
+                page.append(status)
+                if len(page) == MAX_FRIENDSHIPS_PER_PAGE:
+                    if not put(page):
+                        return
+                    page = []
+            if page and not put(page):
+                return
+            put(None)
+        except Exception as e:
+            put(e)
+        finally:
+            statuses.close()
+
+    def _page_fetched(self, resp, statuses):
+        if self.on_page:
+            self.on_page(resp.url, statuses)
+
+    def get(self, *args, **kwargs):
+        """
+        Request the API, retrying the errors classified by classify_error as
+        scheduled by the retry policy.
+        """
+        started = self.retry_policy.clock()
+        errors = Counter()
+        while True:
+            if self.limiter and args[0] != RATE_LIMIT_URL:
+                paced = self.limiter.acquire()
+                if paced:
+                    metrics.inc("weibo_api_sleep_seconds_total", paced, reason="pacing")
+            access_token = self.access_token
+            r, error = None, None
+            try:
+                r = self.client.get(*args, **kwargs)
+            except APIError as e:
+                log.error("caught APIError error %s", e)
+                error = e
+            except CONNECTION_ERRORS as e:
+                log.error("caught connection error %s", e)
+                error = e
+
+            if r is not None and r.status_code == 200:
+                if args[0] != RATE_LIMIT_URL:
+                    RateLimitState.for_token(access_token).hit()
+                    if self._rate_limited_tokens:
+                        with self._rotate_lock:
+                            self._rate_limited_tokens.clear()
+                return r
+
+            kind = classify_error(r.status_code if r is not None else None, error)
+            if kind is None:
+                if error is not None:
+                    raise error
+                r.raise_for_status()
+                return r
+            errors[kind] += 1
+            if isinstance(error, APIError):
+                code = error.error_code
             else:
-                raise e
-        except requests.exceptions.ConnectionError as e:
-            log.error("caught connection error %s", e)
-            self._connect()
-            return self.get(*args, **kwargs)
+                code = r.status_code if r is not None else type(error).__name__
+            metrics.inc("weibo_api_retries_total", kind=kind, code=code)
+
+            if kind == RETRY_RATE_LIMIT:
+                if args[0] == RATE_LIMIT_URL:
+                    # not rate limited itself, the caller falls back to the hourly reset
+                    if error is not None:
+                        raise error
+                    r.raise_for_status()
+                self._rate_limited(access_token, error.error_code if error is not None else r.status_code, started)
+                continue
+
+            if self.retry_policy.gives_up(kind, errors[kind]):
+                logging.warning("Too many %s errors from Weibo API, stop!", kind)
+                if error is not None:
+                    raise error
+                r.raise_for_status()
+            # the connection pool discards the failed connection, so the
+            # retry gets a new one while the others are kept alive
+            seconds = self.retry_policy.backoff(errors[kind])
+            logging.warning("%s from Weibo API, sleeping %.1fs", error or r.status_code, seconds)
+            self._sleep(seconds, started, "retry")
+
+    def _rate_limited(self, access_token, error_code, started):
+        """
+        Account a rate limit error of the access token, then rotate to another access
+        token or sleep until the rate limit is reset.
+        :param started: the clock time of the first try of the request
+        """
+        state = RateLimitState.for_token(access_token)
+        if error_code in RATE_LIMIT_ERROR_CODES:
+            state.exhausted(ip=error_code == 10022)
+        else:
+            # a 429 does not tell which limit is reached, the rate limit status does
+            state.invalidate()
+        if self.limiter:
+            self.limiter.reset()
+        # the ip limit applies whatever the access token
+        if error_code in (10023, 10024) and self._rotate(access_token):
+            # the rotations are bounded by the time budget too
+            self.retry_policy.check(0, started)
+            return
+        seconds = self.wait_time()
+        logging.warning("Rate limit %d from Weibo API, Sleep %d to try...", error_code, seconds)
+        self._sleep(seconds, started, "rate_limit")
+
+    def _sleep(self, seconds, started, reason):
+        started_sleep = time.monotonic()
+        try:
+            self.retry_policy.sleep(seconds, started)
+        finally:
+            metrics.inc("weibo_api_sleep_seconds_total", time.monotonic() - started_sleep, reason=reason)
 
     def rate_limit(self):
         """
@@ -323,8 +670,18 @@ class Weiboarc(object):
         since the rate_limit_status is without the rate limit, we can
         use it to count the sleep time.
         """
-        res = self.get('account/rate_limit_status')
-        return res.json()
+        res = self.get(RATE_LIMIT_URL)
+        rl = res.json()
+        self.rate_limit_state.update(rl)
+        return rl
+
+    def rate_limit_status(self):
+        """
+        The locally accounted rate limit, only calling the API when it is stale.
+        """
+        if self.rate_limit_state.stale():
+            self.rate_limit()
+        return self.rate_limit_state.status()
 
     def wait_time(self):
         """
@@ -333,24 +690,46 @@ class Weiboarc(object):
         refer https://github.com/ghostrong/weibo-crawler/blob/master/example.py
         """
         try:
-            rl = self.rate_limit()
+            rl = self.rate_limit_status()
         except Exception as e:
             rl = None
 
-        if rl:
-            if rl['remaining_ip_hits'] > 1 and rl['remaining_user_hits'] > 1:
-                return 60
-            return rl['reset_time_in_seconds'] + 10
+        return wait_seconds(rl)
 
-        now = datetime.now()
-        reset = now + timedelta(seconds=3600 - now.minute * 60 - now.second)
-        reset_ts = time.mktime(datetime.timetuple(reset))
-        return reset_ts - time.time() + 60
+    def _rotate(self, exhausted_token):
+        """
+        Switch to the access token with the most remaining user hits.
+        :param exhausted_token: the access token which reached its rate limit
+        :return: False if there is no other access token with hits left, or if all
+        of them were rate limited since the last successful request
+        """
+        with self._rotate_lock:
+            self._rate_limited_tokens.add(exhausted_token)
+            if self.access_token != exhausted_token:
+                # already rotated by another request
+                return True
+
+            def remaining(token):
+                hits = RateLimitState.for_token(token).remaining_hits()
+                # an unknown budget is worth a try
+                return float('inf') if hits is None else hits
+
+            candidates = [token for token in self.access_tokens if token not in self._rate_limited_tokens]
+            if not candidates:
+                return False
+            token = max(candidates, key=remaining)
+            if remaining(token) <= 0:
+                return False
+            log.info("rotating to access token %d of %d", self.access_tokens.index(token) + 1,
+                     len(self.access_tokens))
+            self.access_token = token
+            self.client.set_access_token(token)
+            return True
 
     def _connect(self):
         log.info("creating client session...")
         try:
-            self.client = Client(access_token=self.access_token)
+            self.client = Client(access_token=self.access_token, pool_maxsize=self.pool_maxsize)
         except Exception as e:
             log.error("creating client session error,%s", e)
             raise e
@@ -392,6 +771,248 @@ class Weiboarc(object):
         return left
 
 
+class RateLimitState(object):
+    """
+    The remaining hits of an access token, accounted locally from the responses
+    and refreshed from account/rate_limit_status when older than the ttl. The
+    state is shared by all the Weiboarc instances of the process using the
+    same access token.
+    """
+    _states = {}
+    _states_lock = threading.Lock()
+
+    def __init__(self, ttl=RATE_LIMIT_TTL, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.remaining_ip_hits = None
+        self.remaining_user_hits = None
+        self.reset_at = None
+        self.refreshed_at = None
+        # set by a rate limit error, even if the state was never refreshed
+        self.exhausted_until = None
+
+    @classmethod
+    def for_token(cls, access_token):
+        with cls._states_lock:
+            if access_token not in cls._states:
+                cls._states[access_token] = cls()
+            return cls._states[access_token]
+
+    def stale(self):
+        with self.lock:
+            if self.refreshed_at is None:
+                return True
+            now = self.clock()
+            return now - self.refreshed_at > self.ttl or now >= self.reset_at
+
+    def update(self, rl):
+        """
+        Refresh from the response of account/rate_limit_status.
+        """
+        with self.lock:
+            self.remaining_ip_hits = rl['remaining_ip_hits']
+            self.remaining_user_hits = rl['remaining_user_hits']
+            self.refreshed_at = self.clock()
+            self.reset_at = self.refreshed_at + rl['reset_time_in_seconds']
+            self.exhausted_until = None
+
+    def hit(self):
+        """
+        Account a request counting against the rate limit.
+        """
+        with self.lock:
+            self.exhausted_until = None
+            if self.refreshed_at is not None:
+                self.remaining_ip_hits = max(self.remaining_ip_hits - 1, 0)
+                self.remaining_user_hits = max(self.remaining_user_hits - 1, 0)
+
+    def exhausted(self, ip=False):
+        """
+        Account a rate limit error from the API.
+        :param ip: the IP limit is reached, otherwise the user limit
+        """
+        with self.lock:
+            now = self.clock()
+            if self.refreshed_at is not None and self.reset_at > now:
+                if ip:
+                    self.remaining_ip_hits = 0
+                else:
+                    self.remaining_user_hits = 0
+                self.exhausted_until = self.reset_at
+            else:
+                # not known from the rate limit status, estimated
+                self.exhausted_until = now + seconds_to_reset()
+
+    def invalidate(self):
+        """
+        Refresh from the API on the next rate limit status.
+        """
+        with self.lock:
+            self.refreshed_at = None
+
+    def remaining_hits(self):
+        """
+        The hits left before a rate limit error, or None if not known.
+        """
+        with self.lock:
+            if self.exhausted_until is not None and self.clock() < self.exhausted_until:
+                return 0
+        if self.stale():
+            return None
+        with self.lock:
+            return min(self.remaining_ip_hits, self.remaining_user_hits)
+
+    def status(self):
+        """
+        The state in the shape of the account/rate_limit_status response.
+        """
+        with self.lock:
+            return {
+                'remaining_ip_hits': self.remaining_ip_hits,
+                'remaining_user_hits': self.remaining_user_hits,
+                'reset_time_in_seconds': max(int(math.ceil(self.reset_at - self.clock())), 0)
+            }
+
+
+class RetryPolicy(object):
+    """
+    Schedules the retries of the failed requests with an exponential backoff
+    and jitter, within a time budget for each request and a deadline for the
+    whole harvest.
+    """
+    # max tries by kind of error, the rate limit errors are only bounded by the time budget
+    max_tries = {
+        RETRY_NOT_FOUND: 10,
+        RETRY_SERVER_ERROR: 30,
+        RETRY_CONNECTION: 30
+    }
+
+    def __init__(self, base=2, cap=300, request_budget=None, deadline=None, stop_event=None,
+                 clock=time.monotonic):
+        """
+        :param base: the seconds of the first backoff
+        :param cap: the max seconds of a backoff
+        :param request_budget: the max seconds spent retrying a request
+        :param deadline: the clock time after which no request is retried
+        :param stop_event: a threading.Event interrupting the sleeps when set
+        """
+        self.base = base
+        self.cap = cap
+        self.request_budget = request_budget
+        self.deadline = deadline
+        self.stop_event = stop_event
+        self.clock = clock
+
+    def backoff(self, errors):
+        """
+        The seconds to sleep after the given number of errors of a kind.
+        """
+        seconds = min(self.cap, self.base * 2 ** (errors - 1))
+        return seconds / 2.0 + random.uniform(0, seconds / 2.0)
+
+    def gives_up(self, kind, errors):
+        return errors > self.max_tries.get(kind, float('inf'))
+
+    def check(self, seconds, started):
+        """
+        Raise RetryBudgetExceeded if sleeping would go past the time budget.
+        :param seconds: the seconds to sleep before the retry
+        :param started: the clock time of the first try of the request
+        """
+        now = self.clock()
+        if self.request_budget is not None and now + seconds - started > self.request_budget:
+            raise RetryBudgetExceeded("retrying for {:.0f}s would exceed the request time budget of {}s".format(
+                seconds, self.request_budget))
+        if self.deadline is not None and now + seconds > self.deadline:
+            raise RetryBudgetExceeded("retrying for {:.0f}s would exceed the harvest time budget".format(seconds))
+
+    def sleep(self, seconds, started):
+        self.check(seconds, started)
+        if self.stop_event is not None:
+            if self.stop_event.wait(seconds):
+                raise RetryBudgetExceeded("stop requested while waiting to retry")
+        else:
+            time.sleep(seconds)
+
+
+class TokenBucket(object):
+    """
+    A client side token bucket to pace the requests. It is seeded from
+    account/rate_limit_status, so the remaining hits are spread across the
+    rest of the rate limit window instead of being used in a burst.
+    """
+
+    def __init__(self, rate_limit, burst=10, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param rate_limit: callable returning the rate limit status
+        :param burst: the max number of requests issued without pacing
+        """
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.tokens = 0
+        self.rate = None
+        self.updated = None
+        self.reset_at = None
+
+    def seed(self, rl):
+        """
+        Refill the bucket from a rate limit status.
+        """
+        remaining = max(min(rl['remaining_ip_hits'], rl['remaining_user_hits']), 0)
+        reset_in = max(rl['reset_time_in_seconds'], 1)
+        self.tokens = min(self.burst, remaining)
+        self.rate = float(remaining - self.tokens) / reset_in
+        self.updated = self.clock()
+        self.reset_at = self.updated + reset_in
+        log.debug("token bucket seeded with %s remaining hits for %s seconds", remaining, reset_in)
+
+    def reset(self):
+        """
+        Reseed the bucket before the next request, e.g. after a rate limit error.
+        """
+        with self.lock:
+            self.reset_at = None
+
+    def acquire(self):
+        """
+        Take a token, sleeping until one is available.
+        :return: the seconds slept
+        """
+        with self.lock:
+            now = self.clock()
+            if self.reset_at is None or now >= self.reset_at:
+                try:
+                    self.seed(self.rate_limit())
+                except Exception as e:
+                    log.warning("cannot get the rate limit status, not pacing requests for 60s: %s", e)
+                    self.rate = None
+                    self.reset_at = now + 60
+                now = self.clock()
+            if self.rate is None:
+                return 0
+
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+
+            # reserve the token, the requests waiting after this one queue behind it
+            if self.rate > 0:
+                seconds = min((1 - self.tokens) / self.rate, self.reset_at - now)
+            else:
+                seconds = self.reset_at - now
+            self.tokens -= 1
+
+        log.debug("pacing requests, sleeping %.2fs", seconds)
+        self.sleep(seconds)
+        return seconds
+
+
 class APIError(Exception):
     """
     raise APIError if got failed message from the API not the http error.
@@ -407,13 +1028,123 @@ class APIError(Exception):
         return 'APIError: %s, %s, Request: %s' % (self.error_code, self.error, self.request)
 
 
+class WeiboResponse(object):
+    """
+    Wraps the http response, so the body is decoded only once however many
+    times json() is called. The other attributes are the ones of the wrapped
+    response.
+    """
+
+    def __init__(self, response, status_code, content, decoder=None):
+        self.response = response
+        self.status_code = status_code
+        self.content = content
+        self.decoder = decoder or json_loads
+        self._json = None
+
+    def json(self):
+        if self._json is None:
+            self._json = self.decoder(self.content)
+        return self._json
+
+    def iter_statuses(self):
+        return iter(self.json().get('statuses', []))
+
+    def raise_for_status(self):
+        self.response.raise_for_status()
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+
+class WeiboStreamResponse(object):
+    """
+    Wraps a streamed 200 response, its statuses are parsed incrementally as
+    the body is received from the socket. An error body raises APIError once
+    parsed. The other attributes are the ones of the wrapped response.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status_code
+        self.response.raw.decode_content = True
+
+    def iter_statuses(self):
+        error = {}
+        builder = None
+        try:
+            for prefix, event, value in ijson.parse(self.response.raw, use_float=True):
+                if builder is not None:
+                    builder.event(event, value)
+                    if prefix == 'statuses.item' and event == 'end_map':
+                        yield builder.value
+                        builder = None
+                elif prefix == 'statuses.item' and event == 'start_map':
+                    builder = ObjectBuilder()
+                    builder.event(event, value)
+                elif prefix in ('error_code', 'error', 'request'):
+                    error[prefix] = value
+        finally:
+            self.response.close()
+        if 'error_code' in error and 'error' in error:
+            raise APIError(error['error_code'], error['error'], error.get('request', ''))
+
+    def raise_for_status(self):
+        self.response.raise_for_status()
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+
+class RetryBudgetExceeded(Exception):
+    """
+    raise RetryBudgetExceeded if a request cannot be retried within its time budget.
+    """
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter enabling TCP keep-alive on the pooled connections, including
+    the ones to a proxy such as warcprox, so idle connections between pages are
+    not silently dropped by the network.
+    """
+    __attrs__ = HTTPAdapter.__attrs__ + ['keep_alive_idle']
+
+    def __init__(self, keep_alive_idle=60, **kwargs):
+        """
+        :param keep_alive_idle: seconds of idle before the keep-alive probes, None to disable
+        """
+        self.keep_alive_idle = keep_alive_idle
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def socket_options(self):
+        options = list(HTTPConnection.default_socket_options)
+        if self.keep_alive_idle:
+            options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            # not available on all the platforms
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.keep_alive_idle))
+            if hasattr(socket, 'TCP_KEEPINTVL'):
+                options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(self.keep_alive_idle // 4, 1)))
+        return options
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = self.socket_options()
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        proxy_kwargs['socket_options'] = self.socket_options()
+        return HTTPAdapter.proxy_manager_for(self, proxy, **proxy_kwargs)
+
+
 class Client(object):
     """
     Refer from https://github.com/lxyu/weibo/blob/master/weibo.py
     Since we need deal withe the http response error code
     """
 
-    def __init__(self, access_token, api_key=None, api_secret=None, redirect_uri=None):
+    def __init__(self, access_token, api_key=None, api_secret=None, redirect_uri=None, decoder=None,
+                 pool_connections=10, pool_maxsize=10, keep_alive_idle=60):
         # const define
         self.site = 'https://api.weibo.com/'
         self.authorization_url = self.site + 'oauth2/authorize'
@@ -424,9 +1155,18 @@ class Client(object):
         self.client_id = api_key
         self.client_secret = api_secret
         self.redirect_uri = redirect_uri
+        self.decoder = decoder or json_loads
 
         self.session = requests.session()
+        # the connections are kept alive and reused, including their TLS session with the API
+        adapter = KeepAliveAdapter(keep_alive_idle=keep_alive_idle, pool_connections=pool_connections,
+                                   pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         # activate client directly with given access_token
+        self.set_access_token(access_token)
+
+    def set_access_token(self, access_token):
         self.session.params = {'access_token': access_token}
 
     def _assert_error(self, d):
@@ -436,16 +1176,26 @@ class Client(object):
         if 'error_code' in d and 'error' in d:
             raise APIError(d.get('error_code'), d.get('error', ''), d.get('request', ''))
 
-    def get(self, uri, **kwargs):
+    def get(self, uri, stream=False, **kwargs):
         """
         Request resource by get method.
+        :param stream: return a WeiboStreamResponse for a 200 response, its body is not read yet
         """
         # 500 test url
         # self.api_url='https://httpbin.org/status/500'
 
         url = "{0}{1}.json".format(self.api_url, uri)
 
-        res = self.session.get(url, params=kwargs)
+        started = time.monotonic()
+        r = self.session.get(url, params=kwargs, stream=stream)
+        metrics.observe("weibo_api_request_seconds", time.monotonic() - started, endpoint=uri)
+        metrics.inc("weibo_api_requests_total", endpoint=uri, status=r.status_code)
+        if stream and r.status_code == 200:
+            # only the length announced, the body is not read yet
+            metrics.inc("weibo_api_received_bytes_total", int(r.headers.get("Content-Length", 0)), endpoint=uri)
+            return WeiboStreamResponse(r)
+        res = WeiboResponse(r, r.status_code, r.content, decoder=self.decoder)
+        metrics.inc("weibo_api_received_bytes_total", len(res.content), endpoint=uri)
         # other error code with server will be deal in low level app
         # 403 for invalid access token and rate limit
         # 400 for information of expire token